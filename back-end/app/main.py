@@ -7,9 +7,12 @@ sys.path.append(str(Path(__file__).parent.parent))
 
 from dotenv import load_dotenv # type: ignore
 from fastapi import FastAPI   # type: ignore
+from fastapi.responses import JSONResponse # type: ignore
 from fastapi.middleware.cors import CORSMiddleware  # type: ignore
 from routes.chat import router as chat_router
 from app.ws_handler import register_ws
+from app.telemetry import register_metrics
+from services.multi_provider_service import ai_service
 
 # Load environment variables
 load_dotenv()
@@ -33,12 +36,41 @@ app.include_router(chat_router, prefix="/api")
 # Register WebSocket
 register_ws(app)
 
+# Prometheus metrics and Server-Timing
+register_metrics(app)
+
+# Providers load in the background after startup; with PROVIDER_WARMUP=false the first request loads them
+PROVIDER_WARMUP = os.getenv("PROVIDER_WARMUP", "true").lower() == "true"
+
+@app.on_event("startup")
+async def start_provider():
+    ai_service.start(warm_up=PROVIDER_WARMUP)
+
+@app.on_event("shutdown")
+async def close_provider():
+    await ai_service.aclose()
+
 @app.get("/")
 async def root():
     return {"message": "ZBot API is running"}
 
+@app.get("/healthz", include_in_schema=False)
+async def liveness():
+    """The event loop is responsive"""
+    return {"status": "alive"}
+
+@app.get("/readyz", include_in_schema=False)
+async def readiness():
+    """Ready once a provider has warmed up (always, when warm-up is deferred to the first request)"""
+    body = {"ready": ai_service.ready or not PROVIDER_WARMUP, "ready_after_s": ai_service.ready_after,
+            "providers": ai_service.warmup}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
 if __name__ == "__main__":
     import uvicorn # type: ignore
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host=host, port=port)
\ No newline at end of file
+    # permessage-deflate shrinks long answers; browsers offer it and nginx passes the negotiation through.
+    # The Dockerfile passes the same setting to the uvicorn CLI with --ws-per-message-deflate.
+    per_message_deflate = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+    uvicorn.run(app, host=host, port=port, ws_per_message_deflate=per_message_deflate)
\ No newline at end of file
@@ -1,4 +1,15 @@
-from pydantic import BaseModel # type: ignore
+from typing import List, Optional, Union
+from pydantic import BaseModel, Field # type: ignore
 
 class ChatRequest(BaseModel):
-    message: str
\ No newline at end of file
+    message: str
+
+class BatchItem(BaseModel):
+    message: str
+    system_prompt: Optional[str] = None
+    history: Optional[List[dict]] = None  # [{"role": ..., "content": ...}, ...]
+
+class ChatBatchRequest(BaseModel):
+    # A bare string is shorthand for {"message": ...}
+    items: List[Union[str, BatchItem]]
+    concurrency: Optional[int] = Field(default=None, ge=1)
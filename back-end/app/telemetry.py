@@ -0,0 +1,84 @@
+"""
+Prometheus /metrics endpoint and per-request timing
+Every HTTP response carries a Server-Timing header with its phase breakdown
+(queue, upstream_connect, first_token, total) and feeds the latency histograms.
+"""
+from fastapi import Response # type: ignore
+from services.admission import admission
+from services.metrics import registry, http_request_duration, start_timing, current_timing
+from services.multi_provider_service import ai_service
+from services.replay_buffer import replay_store
+from services.response_cache import response_cache
+from services.stream_coalescer import stream_coalescer
+
+
+class TimingMiddleware:
+    """Plain ASGI middleware (no per-request task or body buffering)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = start_timing()
+        status = None
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                timing.finish()
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.server_timing().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = current_timing.set(timing)
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_timing.reset(token)
+            if status is not None:
+                # Observed once the body is sent: a streamed response only picks its backend after the headers
+                # Matched paths only, so unknown URLs cannot blow up label cardinality.
+                # (Routes here have no path parameters and the route object drops the /api prefix.)
+                route = scope["path"] if scope.get("route") is not None else "unmatched"
+                http_request_duration.observe(timing.phases["total"], route=route, method=scope["method"],
+                                              status=status, provider=timing.provider or "none")
+
+
+def _backend_values(field: str) -> dict:
+    return {(b.name,): value for b in ai_service.backends
+            if (value := b.stats()[field]) is not None}
+
+
+def register_metrics(app):
+    app.add_middleware(TimingMiddleware)
+
+    # Values that already live elsewhere are read at scrape time
+    registry.callback("zbot_inflight_generations", "Generations holding an admission slot",
+                      lambda: admission.stats()["active"])
+    registry.callback("zbot_admission_queue_depth", "Requests waiting for a generation slot",
+                      lambda: admission.stats()["queued"])
+    registry.callback("zbot_backend_healthy", "Result of the last health probe (1 healthy, 0 not)",
+                      lambda: {k: int(v) for k, v in _backend_values("healthy").items()}, ("provider",))
+    registry.callback("zbot_backend_ewma_latency_ms", "Smoothed time to first token per backend",
+                      lambda: _backend_values("ewma_latency_ms"), ("provider",))
+    registry.callback("zbot_response_cache_hits_total", "Response cache hits",
+                      lambda: response_cache.hits, kind="counter")
+    registry.callback("zbot_response_cache_misses_total", "Response cache misses",
+                      lambda: response_cache.misses, kind="counter")
+    registry.callback("zbot_coalesced_requests_total", "Streamed requests seen by the coalescer",
+                      lambda: stream_coalescer.requests, kind="counter")
+    registry.callback("zbot_upstream_streams_total", "Upstream streams actually started by the coalescer",
+                      lambda: stream_coalescer.upstream_streams, kind="counter")
+    registry.callback("zbot_ws_replay_streams", "Answers held in replay buffers",
+                      lambda: replay_store.stats()["streams"])
+    registry.callback("zbot_ws_resumed_total", "Answers resumed after a reconnect",
+                      lambda: replay_store.resumed, kind="counter")
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,43 +1,300 @@
+"""
+Framed, multiplexed chat protocol on /ws
+
+Client frames (JSON; plain text is read as a message):
+  {"message": "...", "ref": "c1"}            start a generation; ref is echoed back
+  {"cancel": {"id": "..."}}                  stop a generation and its upstream stream
+  {"resume": {"id": "...", "offset": 12}}    continue an answer after a reconnect
+
+Server frames, all JSON and tagged with the generation id:
+  {"type": "start", "id": ..., "seq": 0, "ref": "c1"}
+  {"type": "chunk", "id": ..., "seq": n, "text": "..."}
+  {"type": "done", "id": ..., "seq": n}      seq is the number of chunks ("cancelled": true if stopped)
+  {"type": "error", "id": ..., "error": "..."}   plus busy/retry_after_ms or expired where relevant
+  {"type": "timing", "id": ..., "timing": {...}} with WS_TIMING_FRAMES=true
+
+Several generations may run on one socket at once; their frames interleave but
+each carries its id and a per-generation sequence number. POST /api/chat/stream
+serves the same frames as Server-Sent Events.
+"""
 import asyncio
-import threading
+import json
+import os
+from typing import Optional
 from fastapi import WebSocket # type: ignore
-from services import openai_services
+from services.multi_provider_service import ai_service
+from services.admission import (admission, client_id_from, AdmissionRejected, ADMISSION_ENABLED,
+                                OUTPUT_TOKEN_ESTIMATE, PRIORITY_INTERACTIVE)
+from services.frame_batching import frame_batcher
+from services.metrics import generations_cancelled, start_timing, websocket_connections
+from services.provider import ErrorChunk
+from services.replay_buffer import ReplayBuffer, ReplayGap, replay_store
+from services.stream_coalescer import stream_coalescer, COALESCING_ENABLED
+from services.session_memory import ChatSession, count_tokens, new_session, SESSION_MEMORY_ENABLED
+
+# Send a timing frame after each answer with its phase breakdown
+TIMING_FRAMES = os.getenv("WS_TIMING_FRAMES", "false").lower() == "true"
+# How long a generation outlives a dropped connection, waiting to be resumed (0 stops it at once)
+RESUME_GRACE_SECONDS = float(os.getenv("WS_RESUME_GRACE_SECONDS", "10"))
+
+# Generations still running, possibly after their client disconnected
+_generations: set = set()
+
+
+def _clean_chunk(chunk: str):
+    """Return (text, is_error) with raw upstream error payloads reduced to a short message"""
+    if isinstance(chunk, ErrorChunk):
+        return str(chunk), True
+    if chunk.startswith("[ERROR]") or "<!DOCTYPE html>" in chunk or len(chunk) > 500:
+        # Extract simple error message
+        if "520" in chunk or "502" in chunk or "503" in chunk:
+            return "OpenAI is down", True
+        elif "quota" in chunk.lower() or "billing" in chunk.lower():
+            return "Quota limit reached", True
+        elif "rate limit" in chunk.lower():
+            return "Rate limit reached", True
+        return "Service unavailable", True
+    return chunk, False
+
+
+def parse_client_frame(raw: str) -> dict:
+    """Normalise a client frame to {"type": "message" | "cancel" | "resume" | "invalid", ...}"""
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        return {"type": "message", "message": raw, "ref": None}
+    if not isinstance(data, dict):
+        return {"type": "message", "message": raw, "ref": None}
+    ref = data.get("ref") if isinstance(data.get("ref"), (str, int)) else None
+    if isinstance(data.get("message"), str):
+        return {"type": "message", "message": data["message"], "ref": ref}
+    if isinstance(data.get("cancel"), dict) and isinstance(data["cancel"].get("id"), str):
+        return {"type": "cancel", "id": data["cancel"]["id"]}
+    if isinstance(data.get("resume"), dict):
+        resume = data["resume"]
+        offset = resume.get("offset", 0)
+        if isinstance(resume.get("id"), str) and isinstance(offset, int) and offset >= 0:
+            return {"type": "resume", "id": resume["id"], "offset": offset}
+    return {"type": "invalid", "ref": ref}
+
+
+async def generate(user_msg: str, history: Optional[list] = None):
+    """One upstream generation, holding an admission slot while it runs"""
+    async with admission.slot(PRIORITY_INTERACTIVE):
+        stream = ai_service.stream(user_msg, None, history)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+
+def reply_stream(user_msg: str, history: Optional[list] = None):
+    """Chunks for a message; identical concurrent prompts share one upstream stream"""
+    if COALESCING_ENABLED:
+        key = ai_service.request_key(user_msg, None, history)
+        return stream_coalescer.stream(key, lambda: generate(user_msg, history))
+    return generate(user_msg, history)
+
+
+async def produce(buffer: ReplayBuffer, user_msg: str, session: Optional[ChatSession] = None):
+    """Run one generation into its replay buffer, independent of any socket
+
+    Cancelling the task closes the upstream stream and frees the admission slot.
+    """
+    buffer.timing = start_timing()
+    history = None
+    if session is not None:
+        # Leave room in the budget for the new message itself
+        history = session.context(reserve_tokens=count_tokens(user_msg))
+    stream = reply_stream(user_msg, history)
+    answer = []
+    error = None
+
+    async def cleaned():
+        nonlocal error
+        async for chunk in stream:
+            text, is_error = _clean_chunk(chunk)
+            if is_error:
+                error = {"error": text}
+                return  # Stop streaming if there's an error
+            answer.append(text)
+            yield text
+
+    # Deltas are joined into fewer, larger frames; the first one goes out immediately
+    frames = frame_batcher.batches(cleaned())
+    try:
+        async for frame in frames:
+            buffer.append(frame)
+        if session is not None and answer and error is None:
+            session.add_user(user_msg)
+            session.add_assistant("".join(answer))
+    except AdmissionRejected as e:
+        # Too many generations queued: tell the client when to try again
+        error = e.to_dict()
+    except asyncio.CancelledError:
+        error = {"cancelled": True}
+        raise
+    except Exception:
+        # Final fallback for any unexpected errors
+        error = {"error": "Service unavailable"}
+    finally:
+        buffer.timing.finish()
+        buffer.finish(error)
+        await frames.aclose()
+        await stream.aclose()
+
+
+def start_generation(user_msg: str, session: Optional[ChatSession] = None) -> ReplayBuffer:
+    buffer = replay_store.create(session)
+    buffer.task = asyncio.create_task(produce(buffer, user_msg, session))
+    # Held here so the generation can outlive the connection that started it
+    _generations.add(buffer.task)
+    buffer.task.add_done_callback(_generations.discard)
+    return buffer
+
+
+def cancel_generation(buffer: ReplayBuffer, reason: str):
+    if buffer.task is not None and not buffer.task.done():
+        buffer.task.cancel()
+        generations_cancelled.inc(reason=reason)
+
+
+def _cancel_if_abandoned(buffer: ReplayBuffer):
+    # Nobody resumed the answer within the grace window
+    if buffer.followers == 0:
+        cancel_generation(buffer, "disconnect")
+
+
+async def buffer_frames(buffer: ReplayBuffer, offset: int = 0, ref=None):
+    """Protocol frames for a generation from offset on: start, chunks, then done or error
+
+    Shared by the WebSocket and the Server-Sent Events endpoint so both speak the same framing.
+    """
+    request_id = buffer.request_id
+    start = {"type": "start", "id": request_id, "seq": offset}
+    if ref is not None:
+        start["ref"] = ref
+    yield start
+    seq = offset
+    frames = buffer.follow(offset)
+    try:
+        async for frame in frames:
+            yield {"type": "chunk", "id": request_id, "seq": seq, "text": frame}
+            seq += 1
+    except ReplayGap as e:
+        yield {"type": "error", "id": request_id, "error": str(e), "expired": True}
+        return
+    finally:
+        await frames.aclose()
+    if buffer.error is not None and not buffer.error.get("cancelled"):
+        yield {"type": "error", "id": request_id, **buffer.error}
+        return
+    yield {"type": "done", "id": request_id, "seq": seq, **(buffer.error or {})}
+    if TIMING_FRAMES:
+        yield {"type": "timing", "id": request_id, "timing": buffer.timing.to_dict()}
+
+
+def release_generation(buffer: ReplayBuffer):
+    """The last reader went away: give the generation RESUME_GRACE_SECONDS to be resumed, then cancel it"""
+    if buffer.done or buffer.followers:
+        return
+    if RESUME_GRACE_SECONDS > 0 and replay_store.enabled:
+        asyncio.get_running_loop().call_later(RESUME_GRACE_SECONDS, _cancel_if_abandoned, buffer)
+    else:
+        cancel_generation(buffer, "disconnect")
+
+
+class Connection:
+    """One socket: serialises sends and tracks the generations it started or resumed"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.session = new_session() if SESSION_MEMORY_ENABLED else None
+        self.client_id = client_id_from(websocket.headers, websocket.client)
+        self.buffers: dict = {}  # generation id -> buffer, while it is being sent
+        self.senders: set = set()
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, frame: dict):
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(frame))
+
+    async def send_buffer(self, buffer: ReplayBuffer, offset: int = 0, ref=None):
+        """Send a generation's frames from offset on
+
+        Each send is awaited, so a slow client only falls behind in the buffer.
+        The buffer is dropped from the connection once sending ends, so a long-lived
+        socket does not keep every answer it ever sent alive.
+        """
+        frames = buffer_frames(buffer, offset, ref)
+        try:
+            async for frame in frames:
+                await self.send(frame)
+        finally:
+            await frames.aclose()
+            if self.buffers.get(buffer.request_id) is buffer:
+                del self.buffers[buffer.request_id]
+            # Sending stopped early (socket closed or failed): the generation waits for a resume
+            release_generation(buffer)
+
+    def follow(self, buffer: ReplayBuffer, offset: int = 0, ref=None):
+        """Send the buffer on its own task so other generations on the socket are not held up"""
+        self.buffers[buffer.request_id] = buffer
+        task = asyncio.create_task(self.send_buffer(buffer, offset, ref))
+        self.senders.add(task)
+        task.add_done_callback(self.senders.discard)
+
+    async def handle(self, frame: dict):
+        kind = frame["type"]
+        if kind == "cancel":
+            buffer = self.buffers.get(frame["id"])
+            if buffer is not None:
+                cancel_generation(buffer, "client")
+        elif kind == "resume":
+            buffer = replay_store.get(frame["id"])
+            if buffer is None:
+                await self.send({"type": "error", "id": frame["id"],
+                                 "error": "Answer is no longer available", "expired": True})
+                return
+            if buffer.owner is not None:
+                self.session = buffer.owner  # Carry on the conversation the answer belongs to
+            self.follow(buffer, frame["offset"])
+        elif kind == "message":
+            user_msg = frame["message"]
+            if ADMISSION_ENABLED:
+                # Charge the rate limits on arrival so a spamming tab is refused straight away
+                context_tokens = self.session.token_count() if self.session is not None else 0
+                try:
+                    admission.check(self.client_id, count_tokens(user_msg) + context_tokens + OUTPUT_TOKEN_ESTIMATE)
+                except AdmissionRejected as e:
+                    await self.send({"type": "error", "id": None, "ref": frame["ref"], **e.to_dict()})
+                    return
+            self.follow(start_generation(user_msg, self.session), ref=frame["ref"])
+        else:
+            await self.send({"type": "error", "id": None, "ref": frame["ref"], "error": "Unrecognised frame"})
+
+    async def close(self):
+        """Stop sending; generations wait RESUME_GRACE_SECONDS for a resume before they are cancelled"""
+        for task in list(self.senders):
+            task.cancel()
+        await asyncio.gather(*self.senders, return_exceptions=True)
 
 
 def register_ws(app):
     @app.websocket("/ws")
     async def websocket_endpoint(websocket:WebSocket):
         await websocket.accept()
-        loop = asyncio.get_event_loop()
+        websocket_connections.inc()
+        connection = Connection(websocket)
         try:
             while True:
-                msg = await websocket.receive_text()
-                def worker(user_msg:str):
-                    try:
-                        # Stream response from OpenAI
-                        for chunk in openai_services.stream_chat_completion(user_msg):
-                            # If chunk contains error messages, clean them up
-                            if chunk.startswith("[ERROR]") or "<!DOCTYPE html>" in chunk or len(chunk) > 500:
-                                # Extract simple error message
-                                if "520" in chunk or "502" in chunk or "503" in chunk:
-                                    asyncio.run_coroutine_threadsafe(websocket.send_text("OpenAI is down"),loop)
-                                elif "quota" in chunk.lower() or "billing" in chunk.lower():
-                                    asyncio.run_coroutine_threadsafe(websocket.send_text("Quota limit reached"),loop)
-                                elif "rate limit" in chunk.lower():
-                                    asyncio.run_coroutine_threadsafe(websocket.send_text("Rate limit reached"),loop)
-                                else:
-                                    asyncio.run_coroutine_threadsafe(websocket.send_text("Service unavailable"),loop)
-                                break  # Stop streaming if there's an error
-                            else:
-                                # Normal response chunk
-                                asyncio.run_coroutine_threadsafe(websocket.send_text(chunk),loop)
-                    except Exception:
-                        # Final fallback for any unexpected errors
-                        asyncio.run_coroutine_threadsafe(websocket.send_text("Service unavailable"),loop)
-                t = threading.Thread(target=worker, args=(msg,),daemon=True)
-                t.start()
+                await connection.handle(parse_client_frame(await websocket.receive_text()))
         except Exception:
             try:
                 await websocket.close()
             except Exception:
                 pass
+        finally:
+            await connection.close()
+            websocket_connections.dec()
@@ -0,0 +1,150 @@
+"""
+Local stand-in for the OpenAI and Ollama APIs, for benchmarks without credentials
+Speaks OpenAI chat completions (JSON and SSE streaming) and Ollama /api/generate
+(JSON and NDJSON streaming) with configurable time to first token, per-token
+latency, jitter and injected errors.
+
+    python -m bench.fake_upstream --port 9100 --token-ms 20 --jitter-ms 10 --error-rate 0.02
+
+Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:9100/v1 (any
+OPENAI_API_KEY) or OLLAMA_BASE_URL=http://127.0.0.1:9100.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from fastapi import FastAPI, Request # type: ignore
+from fastapi.responses import JSONResponse, StreamingResponse # type: ignore
+
+
+class FakeConfig:
+    def __init__(self):
+        self.ttft_ms = float(os.getenv("FAKE_TTFT_MS", "150"))
+        self.token_ms = float(os.getenv("FAKE_TOKEN_MS", "20"))
+        self.jitter_ms = float(os.getenv("FAKE_JITTER_MS", "5"))
+        self.tokens = int(os.getenv("FAKE_TOKENS", "60"))
+        self.error_rate = float(os.getenv("FAKE_ERROR_RATE", "0"))
+        self.error_status = int(os.getenv("FAKE_ERROR_STATUS", "503"))
+        self.midstream_error_rate = float(os.getenv("FAKE_MIDSTREAM_ERROR_RATE", "0"))
+        self.rng = random.Random(int(os.getenv("FAKE_SEED", "0")))
+
+    def delay(self, base_ms: float) -> float:
+        return max(0.0, base_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def fail(self) -> bool:
+        return self.rng.random() < self.error_rate
+
+
+config = FakeConfig()
+app = FastAPI(title="fake upstream")
+
+WORDS = ("the quick brown fox jumps over a lazy dog while streaming tokens arrive one "
+         "by one so that clients can measure latency throughput and tail behaviour").split()
+
+
+def answer_tokens(prompt: str) -> list:
+    """Deterministic answer for a prompt: a short echo followed by filler words"""
+    seed = sum(map(ord, prompt)) % len(WORDS)
+    tokens = [f"Echo: {prompt[:40]}\n"]
+    tokens += [WORDS[(seed + i) % len(WORDS)] + " " for i in range(config.tokens - 1)]
+    return tokens
+
+
+def error_response(kind: str) -> JSONResponse:
+    status = config.error_status
+    if kind == "openai":
+        code = "rate_limit_exceeded" if status == 429 else "server_error"
+        return JSONResponse({"error": {"message": f"Injected {status}", "type": code, "code": code}}, status_code=status)
+    return JSONResponse({"error": f"Injected {status}"}, status_code=status)
+
+
+async def paced(tokens: list):
+    """Yield (index, token) with the configured first-token and per-token delays"""
+    await asyncio.sleep(config.delay(config.ttft_ms))
+    for i, token in enumerate(tokens):
+        if i:
+            await asyncio.sleep(config.delay(config.token_ms))
+        if i and config.rng.random() < config.midstream_error_rate:
+            raise RuntimeError("Injected mid-stream failure")
+        yield i, token
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if config.fail():
+        return error_response("openai")
+    prompt = body["messages"][-1]["content"]
+    tokens = answer_tokens(prompt)
+    created = int(time.time())
+
+    if not body.get("stream"):
+        await asyncio.sleep(config.delay(config.ttft_ms) + len(tokens) * config.token_ms / 1000)
+        return {
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": created, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(tokens)}}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+        }
+
+    async def events():
+        async for _, token in paced(tokens):
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": created, "model": body["model"],
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    if config.fail():
+        return error_response("ollama")
+    tokens = answer_tokens(body["prompt"].rsplit("User:", 1)[-1].strip())
+
+    if not body.get("stream", True):
+        await asyncio.sleep(config.delay(config.ttft_ms) + len(tokens) * config.token_ms / 1000)
+        return {"model": body["model"], "response": "".join(tokens), "done": True}
+
+    async def lines():
+        async for _, token in paced(tokens):
+            yield json.dumps({"model": body["model"], "response": token, "done": False}) + "\n"
+        yield json.dumps({"model": body["model"], "response": "", "done": True}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": "llama2"}]}
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model"}]}
+
+
+if __name__ == "__main__":
+    import uvicorn # type: ignore
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=config.ttft_ms)
+    parser.add_argument("--token-ms", type=float, default=config.token_ms)
+    parser.add_argument("--jitter-ms", type=float, default=config.jitter_ms)
+    parser.add_argument("--tokens", type=int, default=config.tokens)
+    parser.add_argument("--error-rate", type=float, default=config.error_rate)
+    parser.add_argument("--error-status", type=int, default=config.error_status)
+    parser.add_argument("--midstream-error-rate", type=float, default=config.midstream_error_rate)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config.ttft_ms, config.token_ms, config.jitter_ms = args.ttft_ms, args.token_ms, args.jitter_ms
+    config.tokens, config.error_rate, config.error_status = args.tokens, args.error_rate, args.error_status
+    config.midstream_error_rate = args.midstream_error_rate
+    config.rng = random.Random(args.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,263 @@
+"""
+Load generator for the chat backend
+Opens N concurrent WebSocket clients and M REST clients that each send a number
+of messages, then prints a JSON report with throughput, p50/p95/p99 time to
+first token and total latency, error counts and the server's RSS and thread
+count, so runs can be compared between commits.
+
+    python -m bench.fake_upstream --port 9100 &
+    OPENAI_API_KEY=x OPENAI_BASE_URL=http://127.0.0.1:9100/v1 WS_TIMING_FRAMES=true \
+        ADMISSION_ENABLED=false uvicorn app.main:app &
+    python -m bench.load --ws-clients 50 --rest-clients 10 --messages 5 --server-pid <uvicorn pid> --output run.json
+
+An answer on the socket ends at its done or error frame (see app/ws_handler.py
+for the framing), or after --idle-ms without frames.
+Every simulated client shares one address, so per-client admission limits are
+normally switched off.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import uuid
+from typing import Optional
+import httpx
+import websockets
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 1)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": round(ordered[-1] * 1000, 1)
+    }
+
+
+class Results:
+    def __init__(self):
+        self.ttft: list = []
+        self.total: list = []
+        self.chunks: list = []
+        self.ok = 0
+        self.rejected = 0
+        self.errors: dict = {}
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            "requests": self.ok + self.rejected + sum(self.errors.values()),
+            "ok": self.ok,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "throughput_rps": round(self.ok / elapsed, 2) if elapsed else 0.0,
+            "ttft_ms": percentiles(self.ttft),
+            "total_ms": percentiles(self.total),
+            "chunks_per_answer": round(sum(self.chunks) / len(self.chunks), 1) if self.chunks else 0.0
+        }
+
+
+def _parse_frame(frame: str) -> dict:
+    try:
+        data = json.loads(frame)
+    except ValueError:
+        return {"type": "invalid"}
+    return data if isinstance(data, dict) else {"type": "invalid"}
+
+
+def prompt_for(args, client: int, i: int) -> str:
+    # Unique prompts by default so caching and coalescing do not flatter the numbers
+    if args.repeat_prompts:
+        return f"benchmark prompt {i}"
+    return f"benchmark prompt {client}-{i} {uuid.uuid4().hex[:8]}"
+
+
+async def ws_client(args, client: int, results: Results):
+    try:
+        async with websockets.connect(args.ws_url, max_size=None) as ws:
+            for i in range(args.messages):
+                sent = time.perf_counter()
+                await ws.send(json.dumps({"message": prompt_for(args, client, i)}))
+                first = last = None
+                chunks = 0
+                outcome = "ok"
+                while True:
+                    try:
+                        frame = await asyncio.wait_for(ws.recv(), args.idle_ms / 1000 if first else args.timeout)
+                    except asyncio.TimeoutError:
+                        if first is None:
+                            outcome = "timeout"
+                        break
+                    data = _parse_frame(frame)
+                    kind = data.get("type")
+                    if kind == "error":
+                        outcome = "rejected" if data.get("busy") else "upstream_error"
+                        break
+                    if kind == "done":
+                        break
+                    if kind != "chunk":
+                        continue  # Start frame, or the timing frame of the previous answer
+                    now = time.perf_counter()
+                    first = first or now
+                    last = now
+                    chunks += 1
+                if outcome == "ok" and first is not None:
+                    results.ok += 1
+                    results.ttft.append(first - sent)
+                    results.total.append(last - sent)
+                    results.chunks.append(chunks)
+                elif outcome == "rejected":
+                    results.rejected += 1
+                else:
+                    results.error(outcome)
+                if args.think_ms:
+                    await asyncio.sleep(args.think_ms / 1000)
+    except Exception as e:
+        results.error(type(e).__name__)
+
+
+async def rest_client(args, client: int, results: Results, http: httpx.AsyncClient):
+    for i in range(args.messages):
+        sent = time.perf_counter()
+        try:
+            response = await http.post(args.rest_url, json={"message": prompt_for(args, client, i)}, timeout=args.timeout)
+        except Exception as e:
+            results.error(type(e).__name__)
+            continue
+        elapsed = time.perf_counter() - sent
+        if response.status_code == 200:
+            results.ok += 1
+            # No streaming on this route: the first byte is the whole answer
+            results.ttft.append(elapsed)
+            results.total.append(elapsed)
+        elif response.status_code in (429, 503):
+            results.rejected += 1
+        else:
+            results.error(f"http_{response.status_code}")
+        if args.think_ms:
+            await asyncio.sleep(args.think_ms / 1000)
+
+
+def read_process(pid: int) -> Optional[dict]:
+    """RSS (MB) and thread count from /proc (Linux)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {"rss_mb": int(fields["VmRSS"].split()[0]) / 1024, "threads": int(fields["Threads"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+async def scrape_threads(http: httpx.AsyncClient, metrics_url: str) -> Optional[dict]:
+    try:
+        response = await http.get(metrics_url, timeout=5)
+        for line in response.text.splitlines():
+            if line.startswith("zbot_threads "):
+                return {"threads": int(float(line.split()[1]))}
+    except Exception:
+        pass
+    return None
+
+
+async def sample_server(args, http: httpx.AsyncClient, samples: list, stop: asyncio.Event):
+    while True:
+        sample = read_process(args.server_pid) if args.server_pid else await scrape_threads(http, args.metrics_url)
+        if sample:
+            samples.append(sample)
+        try:
+            await asyncio.wait_for(stop.wait(), args.sample_ms / 1000)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+def server_report(samples: list) -> dict:
+    if not samples:
+        return {}
+    report = {}
+    for field in ("rss_mb", "threads"):
+        values = [s[field] for s in samples if field in s]
+        if values:
+            report[f"{field}_start"] = round(values[0], 1)
+            report[f"{field}_peak"] = round(max(values), 1)
+            report[f"{field}_end"] = round(values[-1], 1)
+    return report
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+async def run(args) -> dict:
+    ws_results, rest_results = Results(), Results()
+    samples: list = []
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=max(1, args.rest_clients) + 1)
+    async with httpx.AsyncClient(limits=limits) as http:
+        sampler = asyncio.create_task(sample_server(args, http, samples, stop))
+        started = time.perf_counter()
+        clients = [ws_client(args, c, ws_results) for c in range(args.ws_clients)]
+        clients += [rest_client(args, c, rest_results, http) for c in range(args.rest_clients)]
+        await asyncio.gather(*clients)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await sampler
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "elapsed_s": round(elapsed, 2),
+        "websocket": ws_results.report(elapsed),
+        "rest": rest_results.report(elapsed),
+        "server": server_report(samples)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent WebSocket/REST load for the chat backend")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--ws-clients", type=int, default=20)
+    parser.add_argument("--rest-clients", type=int, default=0)
+    parser.add_argument("--messages", type=int, default=5, help="messages sent by each client")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between a client's messages")
+    parser.add_argument("--idle-ms", type=float, default=1000, help="end an answer after this long without frames")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a first token / REST answer")
+    parser.add_argument("--repeat-prompts", action="store_true", help="send identical prompts (exercises caches)")
+    parser.add_argument("--server-pid", type=int, help="sample RSS and threads from /proc/<pid>")
+    parser.add_argument("--sample-ms", type=float, default=500)
+    parser.add_argument("--output", help="also write the JSON report here")
+    args = parser.parse_args()
+
+    base = args.base_url.rstrip("/")
+    args.ws_url = base.replace("http", "ws", 1) + "/ws"
+    args.rest_url = base + "/api/chat"
+    args.metrics_url = base + "/metrics"
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return 0 if not report["websocket"]["errors"] and not report["rest"]["errors"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
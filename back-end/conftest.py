@@ -0,0 +1,5 @@
+"""Lets the tests import app, routes and services the way the server does"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
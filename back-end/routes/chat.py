@@ -1,16 +1,57 @@
-from fastapi import APIRouter, HTTPException # type: ignore
-from app.models import ChatRequest
-from services.openai_services import chat_completion_with_fallback
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Request # type: ignore
+from fastapi.responses import JSONResponse, StreamingResponse # type: ignore
+from app.models import BatchItem, ChatBatchRequest, ChatRequest
+from app.ws_handler import buffer_frames, release_generation, start_generation
+from services.admission import (admission, client_id_from, AdmissionRejected, ADMISSION_ENABLED,
+                                OUTPUT_TOKEN_ESTIMATE, PRIORITY_BATCH)
+from services.metrics import classify_error, current_timing, set_provider, start_timing
+from services.multi_provider_service import ai_service
+from services.response_cache import response_cache
+from services.semantic_cache import semantic_cache
+from services.stream_coalescer import stream_coalescer
+from services.frame_batching import frame_batcher
+from services.replay_buffer import replay_store
+from services.session_memory import count_tokens
 
 router = APIRouter()
 
+# Generations a single /chat/batch call may run at once (and its default)
+BATCH_MAX_CONCURRENCY = int(os.getenv("CHAT_BATCH_MAX_CONCURRENCY", "8"))
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "10000"))
+# Times an item goes back to the queue after being shed before it is reported as busy
+BATCH_BUSY_RETRIES = int(os.getenv("CHAT_BATCH_BUSY_RETRIES", "3"))
+# Longest an item waits for the client's rate limits to allow it before it is reported as busy
+BATCH_RATE_WAIT_SECONDS = float(os.getenv("CHAT_BATCH_RATE_WAIT_SECONDS", "60"))
+
+# Proxies must pass events through as they are written; nginx reads X-Accel-Buffering
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def busy_response(e: AdmissionRejected) -> JSONResponse:
+    """429 for rate limits, 503 when the generation queue is saturated"""
+    status_code = 503 if e.reason.startswith("queue") else 429
+    retry_after = str(max(1, -(-e.retry_after_ms // 1000)))
+    return JSONResponse(e.to_dict(), status_code=status_code, headers={"Retry-After": retry_after})
+
 
 @router.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request):
     try:
-        # First try the fallback version which handles quota errors gracefully
-        response = chat_completion_with_fallback(request.message)
+        if ADMISSION_ENABLED:
+            client_id = client_id_from(http_request.headers, http_request.client)
+            admission.check(client_id, count_tokens(request.message) + OUTPUT_TOKEN_ESTIMATE)
+        async with admission.slot():
+            # Awaited on the event loop; providers handle quota errors with a fallback answer
+            response = await ai_service.complete(request.message)
         return {"response": response}
+    except AdmissionRejected as e:
+        return busy_response(e)
     except Exception as e:
         # For other errors (connection issues, authentication, etc.), return HTTP error
         error_msg = str(e)
@@ -19,5 +60,196 @@ async def chat_endpoint(request: ChatRequest):
             return {"response": "I'm currently experiencing service limitations. Please try again later."}
         else:
             raise HTTPException(status_code=500, detail=error_msg)
-    
-    
\ No newline at end of file
+
+
+def batch_item_tokens(item: BatchItem) -> int:
+    """Estimated tokens for an item, charged to the client like a chat message"""
+    context = count_tokens(item.system_prompt or "") + sum(count_tokens(str(turn.get("content", ""))) for turn in item.history or [])
+    return count_tokens(item.message) + context + OUTPUT_TOKEN_ESTIMATE
+
+
+async def run_batch_item(index: int, item: BatchItem, client_id: str) -> dict:
+    """One batch result line; failures are reported in the line instead of raised"""
+    request_timing = current_timing.get()  # The batch request's, inherited by this item's task
+    timing = start_timing()  # Per item, so a fallback in one item is not seen by another
+    history = item.history or None
+    charged = not ADMISSION_ENABLED
+    busy_retries, rate_waited = 0, 0.0
+    while True:
+        try:
+            if not charged:
+                # Each item is charged to the client's buckets before it is dispatched, so a
+                # large batch is paced by the same limits as individual requests
+                admission.check(client_id, batch_item_tokens(item))
+                charged = True
+            # Batch work queues behind interactive requests for the same generation slots
+            async with admission.slot(PRIORITY_BATCH):
+                response = await ai_service.complete(item.message, item.system_prompt, history)
+            break
+        except AdmissionRejected as e:
+            wait = e.retry_after_ms / 1000
+            if not charged:
+                # Over the client's budget: wait for it to refill, up to BATCH_RATE_WAIT_SECONDS in all
+                rate_waited += wait
+                if rate_waited > BATCH_RATE_WAIT_SECONDS:
+                    return {"index": index, **e.to_dict()}
+            else:
+                busy_retries += 1
+                if busy_retries > BATCH_BUSY_RETRIES:
+                    return {"index": index, **e.to_dict()}
+            await asyncio.sleep(wait)
+        except Exception as e:
+            return {"index": index, "error": str(e), "error_class": classify_error(e)}
+    timing.finish()
+    if request_timing is not None and timing.provider is not None:
+        request_timing.set_provider(timing.provider)
+    result = {"index": index, "response": response, "latency_ms": round(timing.phases["total"] * 1000, 1)}
+    if "quota_fallback" in timing.phases:
+        result["fallback"] = True  # Canned reply: the provider was out of quota
+    return result
+
+
+async def as_completed_bounded(items: list, concurrency: int, client_id: str):
+    """Run items with at most concurrency in flight, yielding results in completion order"""
+    pending: set = set()
+    queued = iter(enumerate(items))
+
+    def launch():
+        entry = next(queued, None)
+        if entry is not None:
+            index, item = entry
+            if isinstance(item, str):
+                item = BatchItem(message=item)
+            pending.add(asyncio.ensure_future(run_batch_item(index, item, client_id)))
+
+    for _ in range(concurrency):
+        launch()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pending.discard(task)
+                launch()
+                yield task.result()
+    finally:
+        # The client went away: stop the items still running
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+@router.post("/chat/batch")
+async def chat_batch_endpoint(request: ChatBatchRequest, http_request: Request):
+    """Answer many prompts in one call, streamed back as NDJSON in completion order
+
+    Each line is {"index", "response"} or {"index", "error", ...}; a final
+    {"done": true, ...} line carries the totals.
+    """
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    client_id = client_id_from(http_request.headers, http_request.client)
+    concurrency = min(request.concurrency or BATCH_DEFAULT_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+
+    async def lines():
+        ok = failed = 0
+        started = time.perf_counter()
+        async for result in as_completed_bounded(request.items, concurrency, client_id):
+            if "response" in result:
+                ok += 1
+            else:
+                failed += 1
+            yield json.dumps(result) + "\n"
+        yield json.dumps({"done": True, "items": len(request.items), "ok": ok, "failed": failed,
+                          "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def sse_events(buffer, offset: int = 0):
+    """The WebSocket protocol frames as Server-Sent Events
+
+    Chunk events carry an id one past their seq, so the Last-Event-ID a client
+    reconnects with is the offset to resume from.
+    """
+    async def events():
+        frames = buffer_frames(buffer, offset)
+        try:
+            async for frame in frames:
+                event_id = f"id: {frame['seq'] + 1}\n" if frame["type"] == "chunk" else ""
+                yield f"{event_id}data: {json.dumps(frame)}\n\n"
+        finally:
+            await frames.aclose()
+            # The generation keeps its own timing, since it can outlive this request
+            if buffer.timing is not None and buffer.timing.provider is not None:
+                set_provider(buffer.timing.provider)
+            # The client disconnected (or read to the end): same grace period as a dropped socket
+            release_generation(buffer)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@router.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request):
+    """Stream an answer as Server-Sent Events, for clients that cannot open a WebSocket
+
+    Events carry the same JSON frames as /ws. After a dropped connection,
+    GET /chat/stream?id=... picks the answer up again.
+    """
+    if ADMISSION_ENABLED:
+        try:
+            client_id = client_id_from(http_request.headers, http_request.client)
+            admission.check(client_id, count_tokens(request.message) + OUTPUT_TOKEN_ESTIMATE)
+        except AdmissionRejected as e:
+            return busy_response(e)
+    return sse_events(start_generation(request.message))
+
+
+@router.get("/chat/stream")
+async def chat_stream_resume(id: str, offset: Optional[int] = None,
+                             last_event_id: Optional[str] = Header(default=None)):
+    """Resume a streamed answer; EventSource sends Last-Event-ID by itself when it reconnects"""
+    if offset is None:
+        offset = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    buffer = replay_store.get(id)
+    if buffer is None:
+        return JSONResponse({"error": "Answer is no longer available", "expired": True}, status_code=404)
+    return sse_events(buffer, max(offset, 0))
+
+
+@router.get("/cache/stats")
+async def cache_stats():
+    return response_cache.stats()
+
+
+@router.get("/cache/semantic/stats")
+async def semantic_cache_stats():
+    if semantic_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **semantic_cache.stats()}
+
+
+
+@router.get("/admission/stats")
+async def admission_stats():
+    return admission.stats()
+
+
+@router.get("/coalescing/stats")
+async def coalescing_stats():
+    return stream_coalescer.stats()
+
+
+
+@router.get("/providers")
+async def providers():
+    return ai_service.get_provider_info()
+
+
+@router.get("/ws/stats")
+async def ws_stats():
+    return frame_batcher.stats()
+
+
+@router.get("/ws/replay/stats")
+async def ws_replay_stats():
+    return replay_store.stats()
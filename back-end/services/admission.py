@@ -0,0 +1,239 @@
+"""
+Admission control shared by the REST and WebSocket endpoints
+Token buckets limit how many requests and (estimated) tokens each client and the
+whole process may start; a bounded priority queue limits how many generations
+run at once. Requests over a limit are shed with a retry-after hint instead of
+piling up behind the upstream.
+"""
+import asyncio
+import heapq
+import ipaddress
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from .metrics import add_phase, admission_rejections, queue_wait
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BATCH = 2
+
+
+class AdmissionRejected(Exception):
+    """The request was shed; the client should retry after retry_after_ms"""
+
+    def __init__(self, reason: str, retry_after_ms: int):
+        super().__init__(f"Server busy ({reason}), retry after {retry_after_ms} ms")
+        self.reason = reason
+        self.retry_after_ms = retry_after_ms
+
+    def to_dict(self) -> dict:
+        return {
+            "error": f"Server busy, retry after {self.retry_after_ms} ms",
+            "busy": True,
+            "reason": self.reason,
+            "retry_after_ms": self.retry_after_ms
+        }
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # Refill per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until amount is available (0 if it is available now)"""
+        self._refill(now)
+        # A request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class AdmissionController:
+    def __init__(self, client_requests_per_minute: float = 30, client_request_burst: float = 10,
+                 client_tokens_per_minute: float = 20000, global_requests_per_minute: float = 600,
+                 global_tokens_per_minute: float = 400000, max_concurrent: int = 32,
+                 max_queue: int = 64, max_wait: float = 10.0, max_clients: int = 10000):
+        self.client_requests_per_minute = client_requests_per_minute
+        self.client_request_burst = client_request_burst
+        self.client_tokens_per_minute = client_tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_clients = max_clients
+
+        self._clients: OrderedDict = OrderedDict()  # client id -> (request bucket, token bucket)
+        self._global_requests = TokenBucket(global_requests_per_minute / 60, max(1.0, global_requests_per_minute / 6))
+        self._global_tokens = TokenBucket(global_tokens_per_minute / 60, max(1.0, global_tokens_per_minute / 6))
+
+        self._active = 0
+        self._waiters: list = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._hold_ewma = 1.0  # Seconds a generation holds its slot, for retry hints
+
+        self.admitted = 0
+        self.rejected: dict = {}
+
+    def _client_buckets(self, client_id: str):
+        buckets = self._clients.get(client_id)
+        if buckets is None:
+            buckets = (
+                TokenBucket(self.client_requests_per_minute / 60, self.client_request_burst),
+                TokenBucket(self.client_tokens_per_minute / 60, self.client_tokens_per_minute)
+            )
+            self._clients[client_id] = buckets
+            # Idle clients are forgotten first; a forgotten client just gets a full bucket back
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(client_id)
+        return buckets
+
+    def _reject(self, reason: str, delay: float):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        admission_rejections.inc(reason=reason)
+        raise AdmissionRejected(reason, max(1, int(math.ceil(delay * 1000))))
+
+    def check(self, client_id: str, estimated_tokens: int = 0):
+        """Charge a new request to the client's and the global buckets, or raise AdmissionRejected"""
+        now = time.monotonic()
+        client_requests, client_tokens = self._client_buckets(client_id)
+        # Check every bucket before taking from any, so a rejection costs nothing
+        for reason, bucket, amount in (
+            ("client_requests", client_requests, 1),
+            ("client_tokens", client_tokens, estimated_tokens),
+            ("global_requests", self._global_requests, 1),
+            ("global_tokens", self._global_tokens, estimated_tokens)
+        ):
+            delay = bucket.delay(amount, now)
+            if delay > 0:
+                self._reject(reason, delay)
+        client_requests.take(1)
+        client_tokens.take(estimated_tokens)
+        self._global_requests.take(1)
+        self._global_tokens.take(estimated_tokens)
+
+    def _queue_retry_after(self) -> float:
+        """Rough time until a queued request would start"""
+        return self._hold_ewma * (len(self._waiters) + 1) / max(1, self.max_concurrent)
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_DEFAULT):
+        """Hold one of max_concurrent generation slots, waiting in priority order"""
+        queued_at = time.monotonic()
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self._reject("queue_full", self._queue_retry_after())
+            future = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self._seq), future)
+            heapq.heappush(self._waiters, entry)
+            try:
+                # The slot is handed over by _release, already counted in _active
+                await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done() and not future.cancelled():
+                    self._release()  # Granted at the last moment: pass it on
+                else:
+                    future.cancel()
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._reject("queue_timeout", self._queue_retry_after())
+                raise
+
+        self.admitted += 1
+        started = time.monotonic()
+        queue_wait.observe(started - queued_at, priority=priority)
+        add_phase("queue", started - queued_at)
+        try:
+            yield
+        finally:
+            self._hold_ewma = 0.8 * self._hold_ewma + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def _release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)  # The slot moves straight to the next waiter
+                return
+        self._active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "queued": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "tracked_clients": len(self._clients),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected)
+        }
+
+
+def parse_networks(value: str) -> list:
+    """Comma-separated addresses or CIDR ranges, e.g. 10.0.0.0/8,127.0.0.1"""
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in value.split(",") if part.strip()]
+
+
+def _is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_id_from(headers, client) -> str:
+    """Identify a client by address
+
+    X-Real-IP and X-Forwarded-For are only believed when the connection comes
+    from one of TRUSTED_PROXIES; anyone else could set them to a fresh value on
+    every request and get new token buckets each time.
+    """
+    peer = client.host if client else None
+    if peer and _is_trusted_proxy(peer):
+        real_ip = headers.get("x-real-ip", "").strip()
+        if real_ip:
+            return real_ip
+        # Each proxy appends the address it saw, so the last hop not added by one of ours is the client
+        hops = [hop.strip() for hop in headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not _is_trusted_proxy(hop):
+                return hop
+    return peer or "unknown"
+
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Addresses of the proxies (e.g. the frontend's nginx) whose X-Real-IP is trusted;
+# empty by default because the backend is also reachable directly (NodePort, LoadBalancer)
+TRUSTED_PROXIES = parse_networks(os.getenv("ADMISSION_TRUSTED_PROXIES", ""))
+# Expected answer size added to the prompt's tokens when charging the token buckets
+OUTPUT_TOKEN_ESTIMATE = int(os.getenv("ADMISSION_OUTPUT_TOKEN_ESTIMATE", "256"))
+
+admission = AdmissionController(
+    client_requests_per_minute=float(os.getenv("ADMISSION_CLIENT_RPM", "30")),
+    client_request_burst=float(os.getenv("ADMISSION_CLIENT_BURST", "10")),
+    client_tokens_per_minute=float(os.getenv("ADMISSION_CLIENT_TPM", "20000")),
+    global_requests_per_minute=float(os.getenv("ADMISSION_GLOBAL_RPM", "600")),
+    global_tokens_per_minute=float(os.getenv("ADMISSION_GLOBAL_TPM", "400000")),
+    max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", os.getenv("WS_MAX_INFLIGHT_GENERATIONS", "32"))),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "64")),
+    max_wait=float(os.getenv("ADMISSION_MAX_WAIT_MS", "10000")) / 1000
+)
@@ -0,0 +1,224 @@
+"""
+Dynamic batching engine for local Hugging Face models
+Concurrent requests are queued and grouped so one padded generate() call serves
+several callers instead of running batch-size-1 generations back to back.
+Streaming requests join the same batches: each row's text is handed to its own
+callback as it is decoded, and a row can be stopped without ending the batch.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class _BatchItem:
+    def __init__(self, prompt: str, max_new_tokens: int, on_text=None, stop=None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.on_text = on_text
+        self.stop = stop
+        self.future: Future = Future()
+
+
+class _BatchStreamer:
+    """Streamer for generate() that passes each row's newly decoded text to its item's on_text"""
+
+    def __init__(self, tokenizer, batch: list):
+        self.tokenizer = tokenizer
+        self.batch = batch
+        self.tokens = [[] for _ in batch]
+        self.sent = [0] * len(batch)
+
+    def put(self, value):
+        if value.dim() > 1:
+            return  # The first call carries the prompts
+        for row, (item, token) in enumerate(zip(self.batch, value.tolist())):
+            if item.on_text is None or len(self.tokens[row]) >= item.max_new_tokens:
+                continue
+            if item.stop is not None and item.stop.is_set():
+                continue
+            self.tokens[row].append(token)
+            self.flush(row, final=False)
+
+    def flush(self, row: int, final: bool = True):
+        text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+        if not final and text.endswith("\ufffd"):
+            return  # Wait for the rest of a multi-byte character
+        if len(text) > self.sent[row]:
+            try:
+                self.batch[row].on_text(text[self.sent[row]:])
+            except Exception:
+                self.batch[row].on_text = None  # One consumer failing must not end the other rows
+            self.sent[row] = len(text)
+
+    def end(self):
+        for row, item in enumerate(self.batch):
+            if item.on_text is not None and not (item.stop is not None and item.stop.is_set()):
+                self.flush(row)
+
+
+class _StopRows:
+    """Stopping criterion that ends the rows whose consumer has set their stop event"""
+
+    def __init__(self, torch, batch: list):
+        self.torch = torch
+        self.batch = batch
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stopped = [item.stop is not None and item.stop.is_set() for item in self.batch]
+        return self.torch.tensor(stopped, dtype=self.torch.bool, device=input_ids.device)
+
+
+class BatchingEngine:
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 temperature: float = 0.7, do_sample: bool = True):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.temperature = temperature
+        self.do_sample = do_sample
+
+        # Decoder-only models must be left-padded so every prompt ends where generation starts
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        # Held around every generate() on the model, so callers that run their
+        # own generations on it (the prefix KV cache path) never overlap a batch
+        self.model_lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._closed = False
+        self.batches = 0
+        self.requests = 0
+        self._thread = threading.Thread(target=self._scheduler, name="hf-batching", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, max_new_tokens: int = 100, on_text=None, stop=None) -> Future:
+        """Queue a prompt; the returned future resolves to the generated text
+
+        on_text, if given, is called from the scheduler thread with each new piece
+        of text as it is decoded. Setting the stop event ends this request at the
+        next decode step while the rest of its batch carries on.
+        """
+        if self._closed:
+            raise RuntimeError("Batching engine is closed")
+        item = _BatchItem(prompt, max_new_tokens, on_text, stop)
+        self._queue.put(item)
+        return item.future
+
+    def generate(self, prompt: str, max_new_tokens: int = 100) -> str:
+        """Blocking convenience wrapper around submit()"""
+        return self.submit(prompt, max_new_tokens).result()
+
+    def close(self):
+        """Stop the scheduler after the queued requests finish"""
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first: _BatchItem) -> list:
+        """Gather up to max_batch_size items, waiting at most max_wait after the first"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)  # Keep the shutdown marker for the main loop
+                break
+            batch.append(item)
+        return batch
+
+    def _scheduler(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [item for item in self._collect(first) if item.future.set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch: list):
+        import torch  # Already loaded along with the model; kept out of module import time
+        try:
+            inputs = self.tokenizer([item.prompt for item in batch], return_tensors="pt", padding=True)
+            inputs = inputs.to(self.model.device)
+            max_new_tokens = max(item.max_new_tokens for item in batch)
+            streaming = {}
+            if any(item.on_text is not None for item in batch):
+                streaming["streamer"] = _BatchStreamer(self.tokenizer, batch)
+            if any(item.stop is not None for item in batch):
+                from transformers import StoppingCriteriaList
+                streaming["stopping_criteria"] = StoppingCriteriaList([_StopRows(torch, batch)])
+            with self.model_lock, torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    temperature=self.temperature,
+                    do_sample=self.do_sample,
+                    **streaming
+                )
+            prompt_length = inputs["input_ids"].shape[1]
+            texts = [
+                self.tokenizer.decode(row[prompt_length:prompt_length + item.max_new_tokens], skip_special_tokens=True).strip()
+                for row, item in zip(outputs, batch)
+            ]
+        except Exception as e:
+            self._record(batch)
+            for item in batch:
+                item.future.set_exception(e)
+            return
+        self._record(batch)
+        for item, text in zip(batch, texts):
+            item.future.set_result(text)
+
+    def _record(self, batch: list):
+        # Counted before results are released so callers always see up-to-date stats
+        self.batches += 1
+        self.requests += len(batch)
+
+    def stats(self) -> dict:
+        """Batch counters"""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "queued": self._queue.qsize(),
+            "avg_batch_size": self.requests / self.batches if self.batches else 0.0
+        }
+
+
+if __name__ == "__main__":
+    # Throughput benchmark: python -m services.hf_batching <model> [requests]
+    import sys
+    from concurrent.futures import wait
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "sshleifer/tiny-gpt2"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name).eval()
+    prompts = [f"hello what is zbot {i}" for i in range(count)]
+
+    sequential = BatchingEngine(model, tokenizer, max_batch_size=1)
+    start = time.perf_counter()
+    for prompt in prompts:
+        sequential.generate(prompt, 32)
+    sequential_time = time.perf_counter() - start
+    sequential.close()
+
+    batched = BatchingEngine(model, tokenizer, max_batch_size=8, max_wait_ms=10)
+    start = time.perf_counter()
+    wait([batched.submit(prompt, 32) for prompt in prompts])
+    batched_time = time.perf_counter() - start
+    print(batched.stats())
+    batched.close()
+
+    print(f"sequential: {count / sequential_time:.1f} req/s, batched: {count / batched_time:.1f} req/s "
+          f"({sequential_time / batched_time:.1f}x)")
@@ -0,0 +1,223 @@
+"""
+CPU performance modes for local Hugging Face models
+HF_CPU_MODE picks how the weights are held on CPU-only nodes:
+  fp32  the checkpoint as published (safetensors checkpoints are memory-mapped by
+        recent transformers releases)
+  bf16  half the memory traffic; only used when the CPU has native bf16 (AVX512-BF16/AMX)
+  int8  linear layers dynamically quantized to int8 weights with fp32 activations
+With HF_MODEL_CACHE_DIR set, a converted model's weights are saved there so restarts
+skip the conversion. bf16 weights are written as safetensors, which transformers
+memory-maps on load. int8 weights are saved as a state_dict and loaded with
+weights_only=True into a re-quantized copy of the model structure; the packed int8
+weights live in each process's own memory, so replicas do not share them.
+Nothing in the cache is unpickled as code.
+"""
+import os
+import re
+import shutil
+import time
+import warnings
+
+CPU_MODES = ("fp32", "bf16", "int8")
+
+
+def bf16_supported() -> bool:
+    """Whether the CPU computes bf16 natively; emulated bf16 is slower than fp32"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def resolve_mode(mode: str) -> str:
+    mode = (mode or "fp32").lower()
+    if mode not in CPU_MODES:
+        print(f"Unknown HF_CPU_MODE {mode}, using fp32")
+        return "fp32"
+    if mode == "bf16" and not bf16_supported():
+        print("CPU has no native bf16 support, using fp32")
+        return "fp32"
+    return mode
+
+
+def _cache_path(cache_dir: str, model_name: str, mode: str) -> str:
+    import torch
+    import transformers
+    # Quantized state_dicts are only valid for the library versions that packed them
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name.strip("/"))
+    return os.path.join(cache_dir, f"{name}-{mode}-torch{torch.__version__}-transformers{transformers.__version__}")
+
+
+def _conv1d_to_linear(model):
+    """GPT-2 style models use transformers' Conv1D (a transposed Linear), which dynamic quantization skips"""
+    import torch
+    from transformers.pytorch_utils import Conv1D
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                in_features, out_features = child.weight.shape
+                linear = torch.nn.Linear(in_features, out_features, device="meta")
+                linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+                linear.bias = torch.nn.Parameter(child.bias.detach(), requires_grad=False)
+                setattr(module, name, linear)
+
+
+def convert(model, mode: str):
+    """Apply a CPU mode to a full-precision model"""
+    import torch
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+    if mode == "int8":
+        _conv1d_to_linear(model)
+        with warnings.catch_warnings():
+            # Eager-mode quantization is deprecated in favour of torchao but still the only dependency-free option
+            warnings.simplefilter("ignore")
+            return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _save_cached(model, mode: str, path: str):
+    """Write the converted weights (no pickled modules) to a directory, atomically"""
+    import torch
+    partial = f"{path}.{os.getpid()}.tmp"
+    try:
+        if mode == "int8":
+            model.config.save_pretrained(partial)
+            torch.save(model.state_dict(), os.path.join(partial, "quantized.pt"))
+        else:
+            model.save_pretrained(partial)  # safetensors
+        os.replace(partial, path)  # Replicas starting together never read a half-written cache
+    finally:
+        shutil.rmtree(partial, ignore_errors=True)
+
+
+def _load_cached(path: str, mode: str):
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM
+    from transformers.initialization import no_init_weights
+    if mode == "bf16":
+        return AutoModelForCausalLM.from_pretrained(path, dtype=torch.bfloat16).eval()
+    # The structure is rebuilt and quantized without initialising any weights; the cached ones replace them
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(AutoConfig.from_pretrained(path))
+    model = convert(model.eval(), mode)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # Quantized tensors still go through the deprecated TypedStorage
+        state_dict = torch.load(os.path.join(path, "quantized.pt"), weights_only=True)
+    model.load_state_dict(state_dict)
+    return model
+
+
+def load_causal_lm(model_name: str, device: str = "cpu", mode: str = "fp32", cache_dir: str = None):
+    """Load a causal LM in the given CPU mode, reusing a cached conversion when there is one"""
+    from transformers import AutoModelForCausalLM
+    if device != "cpu":
+        return AutoModelForCausalLM.from_pretrained(model_name).to(device).eval()
+
+    mode = resolve_mode(mode)
+    path = _cache_path(cache_dir, model_name, mode) if cache_dir and mode != "fp32" else None
+    if path and os.path.isdir(path):
+        try:
+            return _load_cached(path, mode)
+        except Exception as e:
+            print(f"Ignoring unreadable model cache {path}: {e}")
+
+    started = time.perf_counter()
+    model = convert(AutoModelForCausalLM.from_pretrained(model_name).eval(), mode)
+    if mode != "fp32":
+        print(f"Converted {model_name} to {mode} in {time.perf_counter() - started:.1f}s")
+    if path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            _save_cached(model, mode, path)
+        except OSError as e:
+            print(f"Could not write model cache {path}: {e}")
+    return model
+
+
+def _rss() -> dict:
+    """Resident memory in MB, split into anonymous and file-backed (page cache shared between processes)"""
+    fields = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "RssAnon", "RssFile"):
+                    fields[key] = int(value.split()[0]) // 1024
+    except OSError:
+        pass
+    return fields
+
+
+def _benchmark_mode(model_name: str, mode: str, cache_dir: str, prompts: list, max_new_tokens: int) -> dict:
+    import torch
+    from transformers import AutoTokenizer
+    from transformers.generation.streamers import BaseStreamer
+
+    class TokenTimer(BaseStreamer):
+        def __init__(self):
+            self.times = []
+            self.prompt_seen = False
+
+        def put(self, value):
+            if self.prompt_seen:
+                self.times.append(time.perf_counter())
+            self.prompt_seen = True
+
+        def end(self):
+            pass
+
+    started = time.perf_counter()
+    model = load_causal_lm(model_name, "cpu", mode, cache_dir)
+    load_seconds = time.perf_counter() - started
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    first_token, rates = [], []
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt")
+        timer = TokenTimer()
+        start = time.perf_counter()
+        with torch.no_grad():
+            model.generate(**inputs, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                           do_sample=False, pad_token_id=tokenizer.eos_token_id, streamer=timer)
+        first_token.append(timer.times[0] - start)
+        rates.append((len(timer.times) - 1) / (timer.times[-1] - timer.times[0]))
+    first_token.sort()
+    return {
+        "mode": resolve_mode(mode),
+        "load_s": round(load_seconds, 2),
+        "first_token_ms_p50": round(first_token[len(first_token) // 2] * 1000, 1),
+        "tokens_per_s": round(sum(rates) / len(rates), 1),
+        "rss_mb": _rss()
+    }
+
+
+def _benchmark_worker(results, *args):
+    results.put(_benchmark_mode(*args))
+
+
+if __name__ == "__main__":
+    # python -m services.hf_cpu_modes <model> [mode ...]
+    # Each mode runs twice in a fresh process: the first run converts and fills the
+    # cache, the second loads from it, as a restarted replica would.
+    import json
+    import multiprocessing
+    import sys
+    import tempfile
+
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "sshleifer/tiny-gpt2"
+    modes = sys.argv[2:] or list(CPU_MODES)
+    prompts = [f"hello what is zbot {i}" for i in range(8)]
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for mode in modes:
+            for run in ("cold", "cached"):
+                results = context.Queue()
+                process = context.Process(target=_benchmark_worker,
+                                          args=(results, model_name, mode, cache_dir, prompts, 32))
+                process.start()
+                result = results.get()
+                process.join()
+                print(json.dumps({"run": run, **result}))
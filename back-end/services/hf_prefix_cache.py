@@ -0,0 +1,72 @@
+"""
+Reuse of past_key_values across conversation turns for local Hugging Face models
+Each new turn's prompt starts with the previous turn's prompt and answer, so the
+attention cache built for those tokens can be cropped and reused; generate()
+then only runs the forward pass for the new tokens.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+
+
+class PrefixKVCache:
+    def __init__(self, max_entries: int = 8, min_prefix_tokens: int = 8):
+        self.max_entries = max_entries
+        self.min_prefix_tokens = min_prefix_tokens
+        self._entries: OrderedDict = OrderedDict()  # id -> (token ids, cache)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    @staticmethod
+    def _common_prefix(cached_ids, input_ids, limit: int) -> int:
+        mismatch = (cached_ids[:limit] != input_ids[:limit]).nonzero()
+        return int(mismatch[0]) if len(mismatch) else limit
+
+    def take(self, input_ids):
+        """Remove and return (cache, prefix_length) for the longest stored prefix of input_ids
+
+        The cache is cropped to the shared prefix. At least one input token is
+        always left uncached so generate() has something to run on.
+        """
+        best_key, best_length = None, 0
+        with self._lock:
+            for key, (cached_ids, _) in self._entries.items():
+                limit = min(len(cached_ids), len(input_ids) - 1)
+                if limit <= best_length:
+                    continue
+                length = self._common_prefix(cached_ids, input_ids, limit)
+                if length > best_length:
+                    best_key, best_length = key, length
+            if best_key is None or best_length < self.min_prefix_tokens:
+                self.misses += 1
+                return None, 0
+            _, cache = self._entries.pop(best_key)
+
+        excess = cache.get_seq_length() - best_length
+        if excess > 0:
+            cache.crop(-excess)  # Negative values drop tokens from the end on every transformers version
+        self.hits += 1
+        self.reused_tokens += best_length
+        return cache, best_length
+
+    def put(self, sequence, cache):
+        """Store the cache produced by generate() for the token ids it covers"""
+        if cache is None or not hasattr(cache, "crop"):
+            return  # Legacy tuple caches cannot be cropped safely
+        length = cache.get_seq_length()
+        with self._lock:
+            self._entries[next(self._ids)] = (sequence[:length], cache)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reused_tokens": self.reused_tokens
+        }
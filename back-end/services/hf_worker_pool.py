@@ -0,0 +1,371 @@
+"""
+Multi-process pool for local Hugging Face inference
+Inside the API process, generation competes with the event loop for the GIL and
+torch's intra-op threads compete with each other for cores. The pool runs
+generation in worker processes instead. A loader process reads the weights once
+and forks the workers from it, so they share the weight pages copy-on-write.
+Each worker is pinned to its own slice of cores with a matching torch thread
+count. Requests, streamed tokens and cancellations travel over one pipe per worker.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+from typing import Optional
+
+# Set in the loader before forking, so forked workers reuse the weights it loaded
+_loaded_service = None
+
+
+def core_slices(workers: int, cores: Optional[list] = None) -> list:
+    """Split the cores this process may run on into one contiguous slice per worker"""
+    if cores is None:
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+    if workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    size, extra = divmod(len(cores), workers)
+    slices, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cores[start:end])
+        start = end
+    return slices
+
+
+def _limit_threads(threads: int):
+    # Read by the OpenMP and MKL runtimes when torch is first imported
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+
+
+def _loader_main(model_name: str, conns: list, slices: list, threads: list):
+    """Load the weights once, then fork one worker per pipe and restart workers that crash"""
+    global _loaded_service
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Shut down by the API process, not by Ctrl-C
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+
+    if context.get_start_method() == "fork":
+        # Single-threaded until the fork: a child cannot use an OpenMP pool its parent started
+        _limit_threads(1)
+        from .huggingface_service import HuggingFaceService, _lib
+        torch = _lib().torch
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        service = HuggingFaceService(model_name, workers=0)
+        try:
+            service.load_weights()
+        except Exception as e:
+            for conn in conns:
+                conn.send(("error", None, f"Could not load model {model_name}: {e}"))
+            return
+        _loaded_service = service
+
+    def start(index: int):
+        process = context.Process(
+            target=_worker_main,
+            args=(model_name, conns[index], slices[index], threads[index]),
+            name=f"hf-worker-{index}"
+        )
+        process.start()
+        return process
+
+    processes = {index: start(index) for index in range(len(conns))}
+    while processes:
+        sentinels = {process.sentinel: index for index, process in processes.items()}
+        for sentinel in multiprocessing.connection.wait(list(sentinels)):
+            index = sentinels[sentinel]
+            process = processes.pop(index)
+            process.join()
+            if process.exitcode == 0:
+                continue  # Shut down, or the API process went away
+            try:
+                conns[index].send(("crashed", None, process.exitcode))
+            except OSError:
+                continue
+            time.sleep(1)  # Do not spin if the worker dies on startup
+            processes[index] = start(index)
+
+
+def _worker_main(model_name: str, conn, cores: Optional[list], threads: int):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    _limit_threads(threads)
+    from .huggingface_service import HuggingFaceService, _lib
+    _lib().torch.set_num_threads(threads)
+    service = _loaded_service or HuggingFaceService(model_name, workers=0)
+    if not service.load_model():
+        conn.send(("error", None, f"Could not load model {model_name}"))
+        return
+    conn.send(("ready", None, {"pid": os.getpid(), "cores": cores, "threads": threads}))
+    asyncio.run(_serve(service, conn))
+
+
+async def _serve(service, conn):
+    """Run requests from the pipe concurrently on the worker's own service"""
+    loop = asyncio.get_running_loop()
+    inbox: asyncio.Queue = asyncio.Queue()
+    tasks: dict = {}
+
+    def receive():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None  # The API process is gone
+            loop.call_soon_threadsafe(inbox.put_nowait, message)
+            if message is None:
+                return
+
+    async def run(kind: str, request_id: int, args: list):
+        try:
+            if kind == "stream":
+                async for chunk in service.stream(*args):
+                    conn.send(("chunk", request_id, chunk))
+                conn.send(("done", request_id, None))
+            else:
+                conn.send(("done", request_id, await service.complete(*args)))
+        except asyncio.CancelledError:
+            pass  # Cancelled by the API process, which no longer waits for it
+        except Exception as e:
+            conn.send(("error", request_id, str(e)))
+        finally:
+            tasks.pop(request_id, None)
+
+    threading.Thread(target=receive, name="hf-worker-pipe", daemon=True).start()
+    while True:
+        message = await inbox.get()
+        if message is None:
+            break
+        kind, request_id, *args = message
+        if kind == "cancel":
+            task = tasks.get(request_id)
+            if task is not None:
+                task.cancel()
+        else:
+            tasks[request_id] = asyncio.create_task(run(kind, request_id, args))
+    for task in list(tasks.values()):
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+class _Worker:
+    """API-process side of one worker: its pipe and the requests waiting on it"""
+
+    def __init__(self, index: int, conn, cores: Optional[list], threads: int):
+        self.index = index
+        self.conn = conn
+        self.cores = cores
+        self.threads = threads
+        self.alive = False
+        self.pid = None
+        self.crashes = 0
+        self.requests: dict = {}  # request id -> (loop, queue)
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def fail(self, error: str):
+        for request_id in list(self.requests):
+            entry = self.requests.pop(request_id, None)
+            if entry is not None:
+                loop, queue = entry
+                loop.call_soon_threadsafe(queue.put_nowait, ("error", error))
+
+
+class InferenceWorkerPool:
+    def __init__(self, model_name: str, workers: int = 2, pin_cores: bool = True,
+                 threads_per_worker: int = 0, start_timeout: float = 600):
+        self.model_name = model_name
+        self.workers = workers
+        self.pin_cores = pin_cores
+        self.threads_per_worker = threads_per_worker
+        self.start_timeout = start_timeout
+
+        self._workers: list = []
+        self._loader = None
+        self._ids = itertools.count()
+        self.requests = 0
+        self.restarts = 0
+
+    def start(self) -> bool:
+        """Start the loader and wait until every worker has the model loaded (blocking)"""
+        context = multiprocessing.get_context("spawn")  # A clean process, without the API's threads
+        slices = core_slices(self.workers)
+        threads = [self.threads_per_worker or len(cores) for cores in slices]
+        pipes = [context.Pipe() for _ in slices]
+        self._loader = context.Process(
+            target=_loader_main,
+            args=(self.model_name, [child for _, child in pipes],
+                  slices if self.pin_cores else [None] * len(slices), threads),
+            name="hf-loader"
+        )
+        self._loader.start()
+        for _, child in pipes:
+            child.close()  # Only the loader and workers hold these ends, so a dead worker reads as EOF
+
+        deadline = time.monotonic() + self.start_timeout
+        for index, ((conn, _), cores, count) in enumerate(zip(pipes, slices, threads)):
+            worker = _Worker(index, conn, cores if self.pin_cores else None, count)
+            self._workers.append(worker)
+            try:
+                message = conn.recv() if conn.poll(max(0.0, deadline - time.monotonic())) else ("error", None, "timed out")
+            except (EOFError, OSError):
+                message = ("error", None, "the loader process exited")
+            if message[0] != "ready":
+                print(f"Inference worker {index} failed to start: {message[2]}")
+                self.close()
+                return False
+            worker.alive = True
+            worker.pid = message[2]["pid"]
+        for worker in self._workers:
+            threading.Thread(target=self._receive, args=(worker,), name=f"hf-pool-{worker.index}", daemon=True).start()
+        return True
+
+    def _receive(self, worker: _Worker):
+        """Route the worker's messages to the waiting requests (runs on its own thread)"""
+        while True:
+            try:
+                kind, request_id, payload = worker.conn.recv()
+            except (EOFError, OSError):
+                worker.alive = False
+                worker.fail("Inference worker exited")
+                return
+            if request_id is None:
+                if kind == "crashed":
+                    # Requests in flight died with the worker; the loader forks a replacement
+                    worker.alive = False
+                    worker.crashes += 1
+                    self.restarts += 1
+                    worker.fail(f"Inference worker crashed (exit code {payload})")
+                elif kind == "ready":
+                    worker.alive = True
+                    worker.pid = payload["pid"]
+                else:
+                    print(f"Inference worker {worker.index}: {payload}")
+                continue
+            entry = worker.requests.get(request_id)
+            if entry is not None:
+                loop, queue = entry
+                loop.call_soon_threadsafe(queue.put_nowait, (kind, payload))
+
+    def _pick(self, affinity: Optional[str]) -> _Worker:
+        alive = [w for w in self._workers if w.alive]
+        if not alive:
+            raise RuntimeError("No inference worker available")
+        least = min(alive, key=lambda w: len(w.requests))
+        if affinity is not None:
+            # Later turns of a conversation go back to the worker holding its KV cache unless it is clearly busier
+            preferred = self._workers[hash(affinity) % len(self._workers)]
+            if preferred.alive and len(preferred.requests) <= len(least.requests) + 1:
+                return preferred
+        return least
+
+    async def _exchange(self, kind: str, message: str, system_prompt: Optional[str], history: Optional[list]):
+        """Send one request and yield (kind, payload) replies until it is done"""
+        worker = self._pick(history[0]["content"] if history else None)
+        request_id = next(self._ids)
+        queue: asyncio.Queue = asyncio.Queue()
+        worker.requests[request_id] = (asyncio.get_running_loop(), queue)
+        self.requests += 1
+        finished = False
+        try:
+            worker.send((kind, request_id, message, system_prompt, history))
+            while True:
+                reply, payload = await queue.get()
+                if reply == "error":
+                    finished = True
+                    raise RuntimeError(payload)
+                finished = reply == "done"
+                yield reply, payload
+                if finished:
+                    return
+        finally:
+            worker.requests.pop(request_id, None)
+            if not finished and worker.alive:
+                # Consumer went away: stop generating at the worker's next decode step
+                worker.send(("cancel", request_id))
+
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        result = None
+        async for _, payload in self._exchange("complete", message, system_prompt, history):
+            result = payload
+        return result
+
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None):
+        async for kind, payload in self._exchange("stream", message, system_prompt, history):
+            if kind == "chunk":
+                yield payload
+
+    def close(self):
+        """Ask the workers to exit and wait for the loader"""
+        for worker in self._workers:
+            worker.alive = False
+            try:
+                worker.send(None)
+            except OSError:
+                pass
+        if self._loader is not None:
+            self._loader.join(timeout=10)
+            if self._loader.is_alive():
+                self._loader.terminate()
+            self._loader = None
+        for worker in self._workers:
+            worker.fail("Inference pool closed")
+            worker.conn.close()
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": [
+                {
+                    "index": w.index,
+                    "pid": w.pid,
+                    "alive": w.alive,
+                    "inflight": len(w.requests),
+                    "cores": w.cores,
+                    "threads": w.threads,
+                    "crashes": w.crashes
+                }
+                for w in self._workers
+            ],
+            "requests": self.requests,
+            "restarts": self.restarts
+        }
+
+
+if __name__ == "__main__":
+    # Throughput against worker count: python -m services.hf_worker_pool <model> [requests] [max workers]
+    import sys
+
+    model_name = sys.argv[1] if len(sys.argv) > 1 else "sshleifer/tiny-gpt2"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else len(core_slices(1)[0])
+
+    async def run(pool: InferenceWorkerPool) -> float:
+        async def one(i: int):
+            async for _ in pool.stream(f"hello what is zbot {i}"):
+                pass
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(count)))
+        return count / (time.perf_counter() - start)
+
+    workers = 1
+    while workers <= max_workers:
+        pool = InferenceWorkerPool(model_name, workers=workers)
+        if not pool.start():
+            break
+        asyncio.run(run(pool))  # Warm-up pass
+        print(f"{workers} worker(s): {asyncio.run(run(pool)):.1f} req/s")
+        pool.close()
+        workers *= 2
@@ -2,70 +2,271 @@
 Hugging Face Transformers service for free LLM inference
 Completely free alternative using local inference
 """
-try:
-    from transformers import pipeline, AutoTokenizer, AutoModelForCausalLM
+import asyncio
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Optional
+from .provider import build_prompt
+from .hf_batching import BatchingEngine
+from .hf_cpu_modes import load_causal_lm
+from .hf_prefix_cache import PrefixKVCache
+
+# Checked without importing: torch and transformers take seconds to import, so
+# that only happens when the model is loaded
+TRANSFORMERS_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ("transformers", "torch"))
+
+
+@lru_cache(maxsize=1)
+def _lib() -> SimpleNamespace:
+    """torch, the transformers classes used here and the streaming helpers built on them"""
     import torch
-    TRANSFORMERS_AVAILABLE = True
-except ImportError:
-    TRANSFORMERS_AVAILABLE = False
+    from transformers import AutoTokenizer, TextStreamer, StoppingCriteria, StoppingCriteriaList
+
+    class AsyncTextStreamer(TextStreamer):
+        """Hands decoded text from the generation thread to an asyncio queue"""
+
+        def __init__(self, tokenizer, loop, chunks):
+            super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+            self.loop = loop
+            self.chunks = chunks
+
+        def on_finalized_text(self, text: str, stream_end: bool = False):
+            if text:
+                self.loop.call_soon_threadsafe(self.chunks.put_nowait, text)
+
+    class StopOnEvent(StoppingCriteria):
+        """Stops generate() once the consumer has cancelled"""
+
+        def __init__(self, event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+    return SimpleNamespace(
+        torch=torch,
+        AutoTokenizer=AutoTokenizer,
+        StoppingCriteriaList=StoppingCriteriaList,
+        AsyncTextStreamer=AsyncTextStreamer,
+        StopOnEvent=StopOnEvent
+    )
+
+# Blocking model work (loading weights, prefix-cached generations) runs here instead
+# of on the event loop; other generations are scheduled by the batching engine's own thread.
+inference_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HF_INFERENCE_THREADS", "1")),
+    thread_name_prefix="hf-inference"
+)
 
 class HuggingFaceService:
-    def __init__(self, model_name: str = "microsoft/DialoGPT-medium"):
+    def __init__(self, model_name: str = "microsoft/DialoGPT-medium", workers: Optional[int] = None):
         if not TRANSFORMERS_AVAILABLE:
             raise ImportError("transformers library not installed. Run: pip install transformers torch")
         
         self.model_name = model_name
-        self.generator = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # With HF_WORKERS > 0 generation runs in a pool of worker processes instead of this one
+        self.workers = int(os.getenv("HF_WORKERS", "0")) if workers is None else workers
+        self.pool = None
+        self.model = None
+        self.tokenizer = None
+        self.engine = None
+        self.prefix_cache = PrefixKVCache(max_entries=int(os.getenv("HF_PREFIX_CACHE_ENTRIES", "8")))
+        self.device = None  # Picked when the model loads
+        self._load_lock = threading.Lock()
         
+    def load_weights(self):
+        """Load the tokenizer and model weights"""
+        lib = _lib()
+        self.device = "cuda" if lib.torch.cuda.is_available() else "cpu"
+        self.tokenizer = lib.AutoTokenizer.from_pretrained(self.model_name)
+        self.model = load_causal_lm(
+            self.model_name,
+            self.device,
+            mode=os.getenv("HF_CPU_MODE", "fp32"),
+            cache_dir=os.getenv("HF_MODEL_CACHE_DIR") or None
+        )
+    
+    def _start_pool(self) -> bool:
+        from .hf_worker_pool import InferenceWorkerPool
+        pool = InferenceWorkerPool(
+            self.model_name,
+            workers=self.workers,
+            pin_cores=os.getenv("HF_WORKER_PIN_CORES", "true").lower() == "true",
+            threads_per_worker=int(os.getenv("HF_WORKER_THREADS", "0")),
+            start_timeout=float(os.getenv("HF_WORKER_START_TIMEOUT", "600"))
+        )
+        if not pool.start():
+            return False
+        self.pool = pool
+        return True
+    
     def load_model(self):
-        """Load the model for inference"""
-        try:
-            if "DialoGPT" in self.model_name:
-                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-                self.model = AutoModelForCausalLM.from_pretrained(self.model_name)
-                self.tokenizer.pad_token = self.tokenizer.eos_token
-            else:
-                self.generator = pipeline(
-                    "text-generation",
-                    model=self.model_name,
-                    device=0 if self.device == "cuda" else -1
+        """Load the model for inference and start its batching engine (or the worker pool)"""
+        with self._load_lock:
+            if self.engine is not None or self.pool is not None:
+                return True
+            if self.workers > 0:
+                return self._start_pool()
+            try:
+                if self.model is None:
+                    self.load_weights()
+                self.engine = BatchingEngine(
+                    self.model,
+                    self.tokenizer,
+                    max_batch_size=int(os.getenv("HF_MAX_BATCH_SIZE", "8")),
+                    max_wait_ms=float(os.getenv("HF_MAX_BATCH_WAIT_MS", "10"))
                 )
-            return True
-        except Exception as e:
-            print(f"Error loading model: {e}")
-            return False
+                return True
+            except Exception as e:
+                print(f"Error loading model: {e}")
+                return False
+    
+    def _format_prompt(self, prompt: str) -> str:
+        """Conversational models expect each turn to end with the EOS token"""
+        if "DialoGPT" in self.model_name:
+            return prompt + self.tokenizer.eos_token
+        return prompt
+    
+    def _format_conversation(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Whole conversation as one prompt; earlier turns render identically every time so their tokens form a stable prefix"""
+        if "DialoGPT" in self.model_name:
+            turns = [turn["content"] for turn in history or [] if turn["role"] != "system"]
+            return "".join(turn + self.tokenizer.eos_token for turn in turns + [message])
+        return build_prompt(message, system_prompt, history or [])
+    
+    def _format_request(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """The prompt for a request, the same whether it is completed or streamed"""
+        if history:
+            return self._format_conversation(message, system_prompt, history)
+        return self._format_prompt(build_prompt(message, system_prompt))
+    
+    def _generate_with_prefix_cache(self, prompt: str, max_new_tokens: int = 100, streamer=None, stop=None) -> str:
+        """Generate, reusing the KV cache of the longest previously seen prefix (runs off the event loop)
+
+        These generations cannot join a batch; the engine's model lock keeps them from
+        running on the model at the same time as one.
+        """
+        lib = _lib()
+        torch = lib.torch
+        input_ids = self.tokenizer(prompt, return_tensors="pt")["input_ids"].to(self.device)
+        cache, _ = self.prefix_cache.take(input_ids[0])
+        with self.engine.model_lock, torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                temperature=0.7,
+                do_sample=True,
+                streamer=streamer,
+                stopping_criteria=lib.StoppingCriteriaList([lib.StopOnEvent(stop)]) if stop is not None else None,
+                return_dict_in_generate=True
+            )
+        sequence = output.sequences[0]
+        self.prefix_cache.put(sequence, output.past_key_values)
+        return self.tokenizer.decode(sequence[input_ids.shape[1]:], skip_special_tokens=True).strip()
     
     def generate_response(self, prompt: str, max_length: int = 100) -> str:
         """Generate response using Hugging Face model"""
+        if self.workers > 0:
+            return "Error: blocking generation is not available with HF_WORKERS; use complete()"
         try:
-            if not self.generator and not self.model:
+            if self.engine is None:
                 if not self.load_model():
                     return "Error: Could not load model"
             
-            if "DialoGPT" in self.model_name:
-                # For conversational models
-                inputs = self.tokenizer.encode(prompt + self.tokenizer.eos_token, return_tensors="pt")
-                
-                with torch.no_grad():
-                    outputs = self.model.generate(
-                        inputs,
-                        max_length=inputs.shape[1] + max_length,
-                        pad_token_id=self.tokenizer.eos_token_id,
-                        temperature=0.7,
-                        do_sample=True
-                    )
-                
-                response = self.tokenizer.decode(outputs[0][inputs.shape[1]:], skip_special_tokens=True)
-                return response.strip()
-            else:
-                # For general text generation
-                result = self.generator(prompt, max_length=max_length, num_return_sequences=1)
-                return result[0]['generated_text'].replace(prompt, '').strip()
+            return self.engine.generate(self._format_prompt(prompt), max_length)
                 
         except Exception as e:
             return f"Error generating response: {str(e)}"
     
+    async def _ensure_loaded(self):
+        if self.engine is None and self.pool is None:
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(inference_executor, self.load_model):
+                raise RuntimeError(f"Could not load model {self.model_name}")
+    
+    async def warm_up(self):
+        """Load the model ahead of the first request"""
+        if os.getenv("HF_PRELOAD", "true").lower() == "true":
+            await self._ensure_loaded()
+    
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Queue the prompt on the batching engine and await its result (follow-up turns use the prefix KV cache instead)"""
+        await self._ensure_loaded()
+        if self.pool is not None:
+            return await self.pool.complete(message, system_prompt, history)
+        prompt = self._format_request(message, system_prompt, history)
+        if history:
+            # Follow-up turns reuse the conversation's KV cache instead of joining a batch
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(inference_executor, self._generate_with_prefix_cache, prompt)
+        return await asyncio.wrap_future(self.engine.submit(prompt))
+    
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None, max_new_tokens: int = 100):
+        """Yield text as each decode step finishes
+
+        New conversations join the batching engine's batches like complete() does.
+        Follow-up turns bypass batching: they reuse the conversation's KV cache on
+        inference_executor, one at a time and never alongside a batch.
+        """
+        await self._ensure_loaded()
+        if self.pool is not None:
+            stream = self.pool.stream(message, system_prompt, history)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.aclose()
+            return
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+        prompt = self._format_request(message, system_prompt, history)
+        
+        if history:
+            streamer = _lib().AsyncTextStreamer(self.tokenizer, loop, chunks)
+            
+            def run():
+                try:
+                    self._generate_with_prefix_cache(prompt, max_new_tokens, streamer, stop)
+                finally:
+                    loop.call_soon_threadsafe(chunks.put_nowait, None)
+            
+            generation = loop.run_in_executor(inference_executor, run)
+        else:
+            future = self.engine.submit(
+                prompt,
+                max_new_tokens,
+                on_text=lambda text: loop.call_soon_threadsafe(chunks.put_nowait, text),
+                stop=stop
+            )
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(chunks.put_nowait, None))
+            generation = asyncio.wrap_future(future)
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+            await generation  # Surface generation errors to the consumer
+        finally:
+            # Consumer went away: end generation at the next decode step
+            stop.set()
+            generation.cancel()  # Drops a request that is still queued for a batch
+    
+    async def aclose(self):
+        """Stop the worker pool"""
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await asyncio.to_thread(pool.close)
+    
     def check_status(self) -> bool:
         """Check if the service is ready"""
-        return TRANSFORMERS_AVAILABLE
\ No newline at end of file
+        return TRANSFORMERS_AVAILABLE
+
@@ -0,0 +1,263 @@
+"""
+Low-overhead Prometheus metrics and per-request phase timing
+A minimal in-process registry (counters, gauges, histograms and scrape-time
+callbacks) rendered in the Prometheus text format, so the hot path is a dict
+update under a lock and no client library is required.
+"""
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from typing import Callable, Optional
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320, 640)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = self.header()
+        for key, value in list(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = self.header()
+        for key, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """Value read at scrape time; the callback returns a number or {label tuple: number}"""
+
+    def __init__(self, name: str, documentation: str, callback: Callable, labelnames: tuple = (), kind: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def render(self) -> list:
+        lines = self.header()
+        try:
+            values = self.callback()
+        except Exception:
+            return lines
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable, labelnames: tuple = (), kind: str = "gauge"):
+        return self.register(CallbackMetric(name, documentation, callback, labelnames, kind))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def classify_error(error) -> str:
+    """Bucket an upstream failure into a small fixed set of classes"""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    text = str(error).lower()
+    if "quota" in text or "insufficient" in text or "billing" in text:
+        return "quota"
+    if status == 429 or "rate limit" in text or "rate_limit" in text:
+        return "rate_limit"
+    if (isinstance(status, int) and 500 <= status < 600) or any(code in text for code in ("500", "502", "503", "504", "520", "<!doctype")):
+        return "server_5xx"
+    if status in (401, 403) or "unauthorized" in text or "api key" in text or "authentication" in text:
+        return "auth"
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "timeout" in text or "timed out" in text:
+        return "timeout"
+    if "connect" in text:
+        return "connection"
+    return "other"
+
+
+class RequestTiming:
+    """Per-request phase durations, reported as Server-Timing or a WebSocket timing frame"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict = {}  # phase -> seconds
+        self.provider: Optional[str] = None  # Backend that served the request, set by the router
+
+    def mark(self, phase: str):
+        """Record the time since the request started, the first time a phase is reached"""
+        if phase not in self.phases:
+            self.phases[phase] = time.perf_counter() - self.started
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self):
+        self.phases["total"] = time.perf_counter() - self.started
+
+    def set_provider(self, name: str):
+        """Label the request with the backend serving it ("mixed" when several did, as in a batch)"""
+        self.provider = name if self.provider in (None, name) else "mixed"
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in self.phases.items())
+
+    def to_dict(self) -> dict:
+        return {f"{phase}_ms": round(seconds * 1000, 1) for phase, seconds in self.phases.items()}
+
+
+# Context of the request being served; tasks started for it inherit the same object
+current_timing: contextvars.ContextVar = contextvars.ContextVar("current_timing", default=None)
+
+
+def start_timing() -> RequestTiming:
+    timing = RequestTiming()
+    current_timing.set(timing)
+    return timing
+
+
+def mark(phase: str):
+    timing: Optional[RequestTiming] = current_timing.get()
+    if timing is not None:
+        timing.mark(phase)
+
+
+def add_phase(phase: str, seconds: float):
+    timing: Optional[RequestTiming] = current_timing.get()
+    if timing is not None:
+        timing.add(phase, seconds)
+
+
+def set_provider(name: str):
+    timing: Optional[RequestTiming] = current_timing.get()
+    if timing is not None:
+        timing.set_provider(name)
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "zbot_http_request_duration_seconds", "HTTP request latency until the response starts",
+    ("route", "method", "status", "provider"))
+upstream_request_duration = registry.histogram(
+    "zbot_upstream_request_duration_seconds", "Time spent on a provider call", ("provider", "mode"))
+time_to_first_token = registry.histogram(
+    "zbot_time_to_first_token_seconds", "Time from dispatch to the first streamed chunk", ("provider",))
+inter_token_latency = registry.histogram(
+    "zbot_inter_token_latency_seconds", "Gap between consecutive streamed chunks", ("provider",),
+    buckets=TOKEN_GAP_BUCKETS)
+stream_tokens_per_second = registry.histogram(
+    "zbot_stream_tokens_per_second", "Streamed chunks per second after the first one", ("provider",),
+    buckets=RATE_BUCKETS)
+stream_tokens = registry.counter(
+    "zbot_stream_tokens_total", "Streamed chunks (deltas) produced by providers", ("provider",))
+upstream_errors = registry.counter(
+    "zbot_upstream_errors_total", "Failed provider calls by error class", ("provider", "error_class"))
+queue_wait = registry.histogram(
+    "zbot_admission_queue_wait_seconds", "Time spent waiting for a generation slot", ("priority",))
+admission_rejections = registry.counter(
+    "zbot_admission_rejected_total", "Requests shed by admission control", ("reason",))
+websocket_connections = registry.gauge(
+    "zbot_websocket_connections", "Open WebSocket connections")
+generations_cancelled = registry.counter(
+    "zbot_ws_generations_cancelled_total", "WebSocket generations stopped before they finished", ("reason",))
+registry.callback("zbot_threads", "Threads in the process", threading.active_count)
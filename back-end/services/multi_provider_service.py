@@ -1,80 +1,201 @@
 """
 Multi-provider AI service that supports OpenAI, Ollama, and other free alternatives
 """
+import asyncio
 import os
+import time
 from typing import Optional
 from dotenv import load_dotenv
+from .response_cache import make_cache_key
+from .provider_router import backend_from_env, router_from_env
 
 # Load environment variables
 load_dotenv()
 
 class MultiProviderAIService:
+    """Routes requests across the configured providers
+
+    Nothing is imported or connected at construction. Providers are created by a
+    background warm-up started with the app (or by the first request), and the
+    service is ready as soon as one of them is usable.
+    """
     def __init__(self):
-        self.provider = os.getenv("AI_PROVIDER", "openai").lower()
-        self.service = None
-        self._initialize_service()
+        # AI_PROVIDERS lists every backend to route between; AI_PROVIDER alone keeps the single-provider setup
+        providers = os.getenv("AI_PROVIDERS") or os.getenv("AI_PROVIDER", "openai")
+        self.providers = [p.strip().lower() for p in providers.split(",") if p.strip()]
+        self.provider = self.providers[0] if self.providers else "mock"
+        self.backends = []
+        self.router = router_from_env(self.backends)
+        self.warmup = {provider: {"state": "pending"} for provider in self.providers}
+        self._order: dict = {}  # backend name -> position of its provider in AI_PROVIDERS
+        self._warmup_task: Optional[asyncio.Task] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._started_at = time.monotonic()
+        self.ready_after: Optional[float] = None
+    
+    @property
+    def service(self):
+        """The first configured backend's service"""
+        return self.backends[0].service if self.backends else None
+    
+    @property
+    def ready(self) -> bool:
+        return self._ready is not None and self._ready.is_set()
+    
+    def _ready_event(self) -> asyncio.Event:
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
+    
+    def start(self, warm_up: bool = True):
+        """Begin probing backend health and, unless deferred to the first request, warming up providers
+
+        Call from a running event loop.
+        """
+        if warm_up and self._warmup_task is None:
+            self._warmup_task = asyncio.create_task(self.warm_up())
+        self.router.start()
+    
+    async def wait_ready(self):
+        """Wait until at least one backend can serve requests, warming up on first use if needed"""
+        if self.ready:
+            return
+        self.start()
+        await self._ready_event().wait()
+    
+    async def warm_up(self):
+        """Create every configured provider concurrently, off the event loop"""
+        self._ready_event()
+        await asyncio.gather(*(self._warm_up_provider(i, provider) for i, provider in enumerate(self.providers)))
+        if not self.backends:
+            self._fallback_to_free_service()
+            await self.router.probe(self.backends[-1])
+            self._mark_ready()
+    
+    async def _warm_up_provider(self, order: int, provider: str):
+        self.warmup[provider] = {"state": "loading"}
+        started = time.monotonic()
+        try:
+            # Imports and client construction run in a worker thread
+            services = await asyncio.to_thread(self._create_services, provider)
+            for name, service in services:
+                if hasattr(service, 'warm_up'):
+                    await service.warm_up()
+                backend = backend_from_env(name, service)
+                # Probed before it is routed to, so /api/providers shows its health straight away
+                await self.router.probe(backend)
+                if not backend.healthy:
+                    print(f"{name} is not responding yet; requests go to it once a health probe succeeds")
+                self._order[name] = order
+                self.backends.append(backend)
+                # Keep configuration order whatever order providers finish in
+                self.backends.sort(key=lambda b: self._order[b.name])
+                self._mark_ready()
+            state = "ready" if services else "unavailable"
+        except Exception as e:
+            print(f"{provider} warm-up failed: {e}")
+            state = "failed"
+        self.warmup[provider] = {"state": state, "seconds": round(time.monotonic() - started, 2)}
+    
+    def _mark_ready(self):
+        if not self.ready:
+            self.ready_after = time.monotonic() - self._started_at
+            self._ready_event().set()
     
-    def _initialize_service(self):
-        """Initialize the appropriate AI service based on provider"""
-        if self.provider == "openai":
+    def _create_services(self, provider: str) -> list:
+        """(name, service) pairs for one provider; empty if it cannot be used"""
+        if provider == "openai":
             try:
                 from .openai_services import OpenAIService
-                self.service = OpenAIService()
-            except ImportError as e:
+                # With other backends to fail over to, errors must raise instead of becoming chunks
+                return [("openai", OpenAIService(raise_errors=len(self.providers) > 1))]
+            except (ImportError, RuntimeError) as e:
                 print(f"OpenAI service not available: {e}")
-                self._fallback_to_free_service()
         
-        elif self.provider == "ollama":
+        elif provider == "ollama":
             try:
                 from .ollama_service import OllamaService
-                self.service = OllamaService()
-                if not self.service.check_status():
-                    print("Ollama server not running. Please start with: ollama serve")
-                    self._fallback_to_free_service()
             except ImportError as e:
                 print(f"Ollama service not available: {e}")
-                self._fallback_to_free_service()
+                return []
+            # OLLAMA_ENDPOINTS adds one backend per Ollama server
+            endpoints = [u.strip() for u in os.getenv("OLLAMA_ENDPOINTS", "").split(",") if u.strip()] or [None]
+            # Servers that are down now are still registered; the probe loop routes to them once they answer
+            services = [OllamaService(endpoint) for endpoint in endpoints]
+            return [(f"ollama@{service.base_url}", service) for service in services]
         
-        elif self.provider == "huggingface":
+        elif provider == "huggingface":
             try:
                 from .huggingface_service import HuggingFaceService
-                self.service = HuggingFaceService()
+                return [("huggingface", HuggingFaceService())]
             except ImportError as e:
                 print(f"HuggingFace service not available: {e}")
-                self._fallback_to_free_service()
         
         else:
-            print(f"Unknown provider: {self.provider}. Falling back to mock service.")
-            self._fallback_to_free_service()
+            print(f"Unknown provider: {provider}.")
+        return []
     
     def _fallback_to_free_service(self):
         """Fallback to a mock service for testing"""
-        self.service = MockAIService()
+        self.backends.append(backend_from_env("mock", MockAIService()))
         print("Using mock AI service for testing. Set AI_PROVIDER environment variable.")
     
-    def get_chat_response(self, message: str, system_prompt: Optional[str] = None) -> str:
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Full answer from the fastest healthy backend; errors propagate to the caller"""
+        await self.wait_ready()
+        return await self.router.complete(message, system_prompt, history)
+    
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None):
+        """Stream the answer from the fastest healthy backend"""
+        await self.wait_ready()
+        stream = self.router.stream(message, system_prompt, history)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+    
+    def request_key(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Key shared by identical requests
+
+        Built from the configured providers rather than the loaded backends, so a
+        prompt gets the same key during warm-up, after it and whichever backend serves it.
+        """
+        return make_cache_key(message, ",".join(self.providers), 0.0, 0, system_prompt, history)
+    
+    async def aclose(self):
+        """Stop warm-up and probing, and release pooled connections held by the backends"""
+        if self._warmup_task is not None and not self._warmup_task.done():
+            self._warmup_task.cancel()
+            await asyncio.gather(self._warmup_task, return_exceptions=True)
+        await self.router.stop()
+        for backend in self.backends:
+            if hasattr(backend.service, 'aclose'):
+                await backend.service.aclose()
+    
+    async def get_chat_response(self, message: str, system_prompt: Optional[str] = None) -> str:
         """Get response from the configured AI provider"""
         try:
-            if hasattr(self.service, 'get_chat_response'):
-                return self.service.get_chat_response(message, system_prompt)
-            elif hasattr(self.service, 'generate_response'):
-                prompt = f"{system_prompt}\n\nUser: {message}" if system_prompt else message
-                return self.service.generate_response(prompt)
-            else:
-                return self.service.get_response(message)
+            return await self.complete(message, system_prompt)
         except Exception as e:
             return f"Error getting AI response: {str(e)}"
     
     def get_provider_info(self) -> dict:
-        """Get information about the current provider"""
-        status = "unknown"
-        if hasattr(self.service, 'check_status'):
-            status = "online" if self.service.check_status() else "offline"
+        """Get information about the current provider (health comes from the background probes)"""
+        health = [b.healthy for b in self.backends]
+        if any(b.available() and b.healthy for b in self.backends):
+            status = "online"
+        elif all(h is None for h in health):
+            status = "starting" if not self.ready else "unknown"
+        else:
+            status = "offline"
         
         return {
             "provider": self.provider,
             "status": status,
-            "service_type": type(self.service).__name__
+            "service_type": type(self.service).__name__,
+            "warmup": self.warmup,
+            **self.router.stats()
         }
 
 class MockAIService:
@@ -98,6 +219,15 @@ class MockAIService:
             return f"[Mock AI with system: {system_prompt[:50]}...] Response to: {message}"
         return self.get_response(message)
     
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Return a mock chat response"""
+        return self.get_chat_response(message, system_prompt)
+    
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None):
+        """Yield the mock response word by word"""
+        for word in self.get_chat_response(message, system_prompt).split(" "):
+            yield word + " "
+    
     def check_status(self) -> bool:
         """Mock service is always available"""
         return True
@@ -2,55 +2,186 @@
 Ollama service for local LLM inference
 This is a free alternative to OpenAI API
 """
-import requests
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Optional
+import httpx
+from .provider import build_prompt
+from .metrics import mark
+
+# Errors worth retrying: the connection was refused or reset before a response arrived
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+
 
 class OllamaService:
-    def __init__(self, base_url: str = "http://localhost:11434"):
-        self.base_url = base_url
-        self.model = "llama2"  # Default model
-    
+    def __init__(self, base_url: str = None, model: str = None):
+        self.base_url = (base_url or os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")).rstrip("/")
+        self.model = model or os.getenv("OLLAMA_MODEL", "llama2")  # Default model
+
+        self.timeout = httpx.Timeout(
+            connect=float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "2")),
+            read=float(os.getenv("OLLAMA_READ_TIMEOUT", "60")),
+            write=float(os.getenv("OLLAMA_WRITE_TIMEOUT", "10")),
+            pool=float(os.getenv("OLLAMA_POOL_TIMEOUT", "5"))
+        )
+        self.total_timeout = float(os.getenv("OLLAMA_TOTAL_TIMEOUT", "120"))
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv("OLLAMA_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("OLLAMA_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "30"))
+        )
+        self.max_retries = int(os.getenv("OLLAMA_RETRIES", "2"))
+        self.retry_backoff = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.1"))
+        self.models_refresh_interval = float(os.getenv("OLLAMA_MODELS_REFRESH_SECONDS", "60"))
+
+        # Pooled keep-alive clients, created on first use
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+        self._models: list = []
+        self._models_fetched_at = 0.0
+        self._models_lock: Optional[asyncio.Lock] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        if self._sync_client is None:
+            self._sync_client = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+        return self._sync_client
+
+    async def aclose(self):
+        """Close the pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    def _backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter so retries from many requests spread out"""
+        return random.uniform(0, self.retry_backoff * (2 ** attempt))
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Send a request on the pool, retrying connection failures"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.client.request(method, path, **kwargs)
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+
     def generate_response(self, prompt: str, model: str = None) -> str:
         """Generate response using Ollama local LLM"""
         try:
             model_name = model or self.model
-            
+
             payload = {
                 "model": model_name,
                 "prompt": prompt,
                 "stream": False
             }
-            
-            response = requests.post(
-                f"{self.base_url}/api/generate",
-                json=payload,
-                timeout=60
-            )
-            
+
+            response = self.sync_client.post("/api/generate", json=payload)
+
             if response.status_code == 200:
                 result = response.json()
                 return result.get("response", "No response generated")
             else:
                 return f"Error: {response.status_code} - {response.text}"
-                
-        except requests.exceptions.RequestException as e:
+
+        except httpx.HTTPError as e:
             return f"Connection error: {str(e)}"
         except Exception as e:
             return f"Error generating response: {str(e)}"
-    
-    def list_models(self) -> list:
-        """List available models in Ollama"""
+
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Generate a response without blocking the event loop"""
+        payload = {
+            "model": self.model,
+            "prompt": build_prompt(message, system_prompt, history),
+            "stream": False
+        }
+        response = await asyncio.wait_for(self._request("POST", "/api/generate", json=payload), self.total_timeout)
+        if response.status_code != 200:
+            raise Exception(f"Ollama error: {response.status_code} - {response.text}")
+        return response.json().get("response", "No response generated")
+
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None):
+        """Yield tokens from Ollama's NDJSON stream as they are generated"""
+        payload = {
+            "model": self.model,
+            "prompt": build_prompt(message, system_prompt, history),
+            "stream": True
+        }
+        deadline = time.monotonic() + self.total_timeout
+        for attempt in range(self.max_retries + 1):
+            started = False
+            try:
+                async with self.client.stream("POST", "/api/generate", json=payload) as response:
+                    mark("upstream_connect")
+                    if response.status_code != 200:
+                        body = await response.aread()
+                        raise Exception(f"Ollama error: {response.status_code} - {body.decode(errors='replace')}")
+                    async for line in response.aiter_lines():
+                        if time.monotonic() > deadline:
+                            raise TimeoutError(f"Ollama stream exceeded {self.total_timeout}s")
+                        if not line.strip():
+                            continue
+                        data = json.loads(line)
+                        if data.get("error"):
+                            raise Exception(f"Ollama error: {data['error']}")
+                        if data.get("response"):
+                            started = True
+                            yield data["response"]
+                        if data.get("done"):
+                            return
+                return
+            except RETRYABLE_ERRORS:
+                # Once tokens went out a retry would duplicate them, so only retry clean failures
+                if started or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+
+    async def list_models(self, refresh: bool = False) -> list:
+        """List available models in Ollama (cached for OLLAMA_MODELS_REFRESH_SECONDS)"""
+        if not refresh and self._models_fetched_at and time.monotonic() - self._models_fetched_at < self.models_refresh_interval:
+            return self._models
+        if self._models_lock is None:
+            self._models_lock = asyncio.Lock()
+        async with self._models_lock:
+            # Another caller may have refreshed while we waited
+            if not refresh and self._models_fetched_at and time.monotonic() - self._models_fetched_at < self.models_refresh_interval:
+                return self._models
+            try:
+                response = await self._request("GET", "/api/tags")
+                if response.status_code == 200:
+                    self._models = response.json().get("models", [])
+                    self._models_fetched_at = time.monotonic()
+            except Exception:
+                pass  # Serve the last known list
+        return self._models
+
+    async def check_status_async(self) -> bool:
+        """Check if Ollama is running without blocking the event loop"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags")
-            if response.status_code == 200:
-                return response.json().get("models", [])
-            return []
+            response = await self.client.get("/api/tags", timeout=5)
+            return response.status_code == 200
         except Exception:
-            return []
-    
+            return False
+
     def check_status(self) -> bool:
         """Check if Ollama is running"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
+            response = self.sync_client.get("/api/tags", timeout=5)
             return response.status_code == 200
         except Exception:
-            return False
\ No newline at end of file
+            return False
@@ -1,86 +1,208 @@
+import asyncio
 import os
 import ssl
 import httpx
+from functools import lru_cache
+from typing import Optional
 from dotenv import load_dotenv # type: ignore
-from openai import OpenAI # type: ignore
-from openai import RateLimitError, APIError, AuthenticationError # type: ignore
+from .response_cache import response_cache, make_cache_key, iter_chunks, CACHE_ENABLED, REPLAY_CHUNK_CHARS
+from .semantic_cache import semantic_cache, make_scope
+from .metrics import classify_error, mark, upstream_errors
+from .provider import ErrorChunk
 
 # Load environment variables
 load_dotenv()
 
+# A missing key only matters once OpenAI is actually used, so importing this module never fails
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_KEY:
-    raise RuntimeError("OPENAI_API_KEY is missing")
-
-# Configure SSL context for environments with certificate issues
-ssl_context = ssl.create_default_context()
-# For corporate environments, you might need to disable SSL verification
-# Uncomment the next line if you're in a corporate environment with SSL issues
-# ssl_context.check_hostname = False
-# ssl_context.verify_mode = ssl.CERT_NONE
 
 # Check if SSL verification should be disabled (for testing/corporate environments)
 disable_ssl_verify = os.getenv("DISABLE_SSL_VERIFY", "false").lower() == "true"
 
-# Create HTTP client with timeout and SSL configuration
-if disable_ssl_verify:
-    print("WARNING: SSL verification is disabled. This is less secure and should only be used for testing.")
-    http_client = httpx.Client(
-        timeout=30.0,  # 30 second timeout
-        verify=False  # Disable SSL verification
+
+def require_key():
+    if not OPENAI_KEY:
+        raise RuntimeError("OPENAI_API_KEY is missing")
+
+
+@lru_cache(maxsize=1)
+def _ssl_verify():
+    """SSL setting shared by both clients"""
+    if disable_ssl_verify:
+        print("WARNING: SSL verification is disabled. This is less secure and should only be used for testing.")
+        return False
+    # Configure SSL context for environments with certificate issues
+    ssl_context = ssl.create_default_context()
+    # For corporate environments, you might need to disable SSL verification
+    # Uncomment the next line if you're in a corporate environment with SSL issues
+    # ssl_context.check_hostname = False
+    # ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+@lru_cache(maxsize=1)
+def get_client():
+    """Sync client, created on first use (the openai package is slow to import)"""
+    require_key()
+    from openai import OpenAI # type: ignore
+    return OpenAI(
+        api_key=OPENAI_KEY,
+        http_client=httpx.Client(timeout=30.0, verify=_ssl_verify())  # 30 second timeout
     )
-else:
-    http_client = httpx.Client(
-        timeout=30.0,  # 30 second timeout
-        verify=ssl_context
+
+
+@lru_cache(maxsize=1)
+def get_async_client():
+    """Async client on a shared HTTP pool, created on first use
+
+    One pool per process keeps TCP/TLS connections to OpenAI warm across WebSocket messages.
+    """
+    require_key()
+    from openai import AsyncOpenAI # type: ignore
+    async_http_client = httpx.AsyncClient(
+        timeout=30.0,
+        verify=_ssl_verify(),
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+        )
     )
+    return AsyncOpenAI(api_key=OPENAI_KEY, http_client=async_http_client)
 
-client = OpenAI(
-    api_key=OPENAI_KEY,
-    http_client=http_client
-)
 DEFAULT_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 
-def chat_completion_sync(message: str, model: str = DEFAULT_MODEL) -> str:
+def _generation_settings() -> tuple:
+    """Current (max_tokens, temperature) from the environment"""
+    max_tokens = int(os.getenv("OPENAI_MAX_TOKENS", "1000"))
+    temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
+    return max_tokens, temperature
+
+def _cache_key(message: str, model: str, system_prompt: Optional[str], history: Optional[list], max_tokens: int, temperature: float, use_cache: bool) -> Optional[tuple]:
+    """(exact key, semantic scope) for the caches, or None when this request must bypass them"""
+    if not (CACHE_ENABLED and use_cache and response_cache.should_cache(temperature)):
+        return None
+    return (
+        make_cache_key(message, model, temperature, max_tokens, system_prompt, history),
+        # A follow-up only means the same thing in the same conversation, so
+        # near-duplicate matching is limited to first turns
+        None if history else make_scope(model, temperature, max_tokens, system_prompt)
+    )
+
+def request_key(message: str, model: str = DEFAULT_MODEL, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+    """Identity of a request: normalized prompt, context and current generation settings"""
+    max_tokens, temperature = _generation_settings()
+    return make_cache_key(message, model, temperature, max_tokens, system_prompt, history)
+
+def _cached_answer(key: tuple, message: str) -> Optional[str]:
+    """Exact-match cache first, then the semantic cache for near-duplicate prompts"""
+    cached = response_cache.get(key[0])
+    if cached is None and semantic_cache is not None and key[1] is not None:
+        cached = semantic_cache.lookup(message, key[1])
+    return cached
+
+def _store_answer(key: tuple, message: str, answer: str):
+    response_cache.set(key[0], answer)
+    if semantic_cache is not None and key[1] is not None:
+        semantic_cache.add(message, answer, key[1])
+
+async def _cached_answer_async(key: tuple, message: str) -> Optional[str]:
+    """_cached_answer for the event loop: the disk tier is read in a worker thread"""
+    cached = await response_cache.aget(key[0])
+    if cached is None and semantic_cache is not None and key[1] is not None:
+        cached = semantic_cache.lookup(message, key[1])
+    return cached
+
+def _store_answer_async(key: tuple, message: str, answer: str):
+    """_store_answer for the event loop: the disk write goes to the cache's writer thread"""
+    response_cache.set_nowait(key[0], answer)
+    if semantic_cache is not None and key[1] is not None:
+        semantic_cache.add(message, answer, key[1])
+
+def _build_messages(message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> list:
+    """Build the chat messages payload"""
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    messages.extend(history or [])
+    messages.append({"role": "user", "content": message})
+    return messages
+
+def _translate_error(e: Exception) -> Exception:
+    """Map an OpenAI/transport exception to the error messages used across the app"""
+    from openai import RateLimitError, APIError, AuthenticationError # type: ignore
+    if isinstance(e, RateLimitError):
+        if "insufficient_quota" in str(e).lower():
+            return Exception("quota_exceeded: OpenAI API quota exceeded. Please check your OpenAI account billing and usage limits at https://platform.openai.com/usage")
+        else:
+            return Exception(f"rate_limit: OpenAI API rate limit exceeded: {str(e)}. Please wait and try again later.")
+    if isinstance(e, AuthenticationError):
+        return Exception(f"OpenAI API authentication failed: {str(e)}. Please check your API key.")
+    if isinstance(e, APIError):
+        return Exception(f"OpenAI API error: {str(e)}")
+    if isinstance(e, ssl.SSLError):
+        return Exception(f"SSL/Certificate error: {str(e)}. This might be due to corporate firewall or network restrictions.")
+    if isinstance(e, httpx.ConnectTimeout):
+        return Exception(f"Connection timeout: {str(e)}. The OpenAI API might be unreachable.")
+    if isinstance(e, httpx.ConnectError):
+        if "certificate verify failed" in str(e).lower():
+            return Exception(f"SSL Certificate verification failed: {str(e)}. This is often caused by corporate firewalls or proxy servers. Please check your network settings.")
+        else:
+            return Exception(f"Network connection error: {str(e)}. Unable to reach OpenAI API servers.")
+
+    error_type = type(e).__name__
+    error_msg = str(e)
+    
+    # Check for quota errors that might be wrapped in other exceptions
+    if "insufficient_quota" in error_msg.lower() or "quota" in error_msg.lower():
+        return Exception(f"OpenAI API quota exceeded: {error_msg}")
+    else:
+        return Exception(f"OpenAI API error ({error_type}): {error_msg}")
+
+def chat_completion_sync(message: str, model: str = DEFAULT_MODEL, system_prompt: Optional[str] = None, history: Optional[list] = None, use_cache: bool = True) -> str:
     """Synchronous chat completion"""
+    max_tokens, temperature = _generation_settings()
+    key = _cache_key(message, model, system_prompt, history, max_tokens, temperature, use_cache)
+    if key is not None:
+        cached = _cached_answer(key, message)
+        if cached is not None:
+            return cached
     try:
-        max_tokens = int(os.getenv("OPENAI_MAX_TOKENS", "1000"))
-        temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
-        
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model=model,
-            messages=[{"role": "user", "content": message}],
+            messages=_build_messages(message, system_prompt, history),
             max_tokens=max_tokens,
             temperature=temperature
         )
-        return response.choices[0].message.content
-    except RateLimitError as e:
-        if "insufficient_quota" in str(e).lower():
-            raise Exception("quota_exceeded: OpenAI API quota exceeded. Please check your OpenAI account billing and usage limits at https://platform.openai.com/usage")
-        else:
-            raise Exception(f"rate_limit: OpenAI API rate limit exceeded: {str(e)}. Please wait and try again later.")
-    except AuthenticationError as e:
-        raise Exception(f"OpenAI API authentication failed: {str(e)}. Please check your API key.")
-    except APIError as e:
-        raise Exception(f"OpenAI API error: {str(e)}")
-    except ssl.SSLError as e:
-        raise Exception(f"SSL/Certificate error: {str(e)}. This might be due to corporate firewall or network restrictions.")
-    except httpx.ConnectTimeout as e:
-        raise Exception(f"Connection timeout: {str(e)}. The OpenAI API might be unreachable.")
-    except httpx.ConnectError as e:
-        if "certificate verify failed" in str(e).lower():
-            raise Exception(f"SSL Certificate verification failed: {str(e)}. This is often caused by corporate firewalls or proxy servers. Please check your network settings.")
-        else:
-            raise Exception(f"Network connection error: {str(e)}. Unable to reach OpenAI API servers.")
+        content = response.choices[0].message.content
+        if key is not None:
+            _store_answer(key, message, content)
+        return content
     except Exception as e:
-        error_type = type(e).__name__
-        error_msg = str(e)
-        
-        # Check for quota errors that might be wrapped in other exceptions
-        if "insufficient_quota" in error_msg.lower() or "quota" in error_msg.lower():
-            raise Exception(f"OpenAI API quota exceeded: {error_msg}")
-        else:
-            raise Exception(f"OpenAI API error ({error_type}): {error_msg}")
+        raise _translate_error(e)
+
+async def chat_completion_async(message: str, model: str = DEFAULT_MODEL, system_prompt: Optional[str] = None, history: Optional[list] = None, use_cache: bool = True) -> str:
+    """Asynchronous chat completion on the shared connection pool"""
+    max_tokens, temperature = _generation_settings()
+    key = _cache_key(message, model, system_prompt, history, max_tokens, temperature, use_cache)
+    if key is not None:
+        cached = await _cached_answer_async(key, message)
+        if cached is not None:
+            return cached
+    try:
+        response = await get_async_client().chat.completions.create(
+            model=model,
+            messages=_build_messages(message, system_prompt, history),
+            max_tokens=max_tokens,
+            temperature=temperature
+        )
+        content = response.choices[0].message.content
+        if key is not None:
+            _store_answer_async(key, message, content)
+        return content
+    except Exception as e:
+        raise _translate_error(e)
+
+def _is_quota_error(e: Exception) -> bool:
+    """True when the error should be answered with a fallback response"""
+    return "quota_exceeded" in str(e) or "rate_limit" in str(e) or "quota" in str(e).lower() or "insufficient_quota" in str(e).lower()
 
 def get_fallback_response(message: str) -> str:
     """Provide a fallback response when OpenAI API is unavailable"""
@@ -98,51 +220,123 @@ def get_fallback_response(message: str) -> str:
     
     return fallback_responses["default"]
 
-def chat_completion_with_fallback(message: str, model: str = DEFAULT_MODEL) -> str:
+def chat_completion_with_fallback(message: str, model: str = DEFAULT_MODEL, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
     """Chat completion with fallback response"""
     try:
-        return chat_completion_sync(message, model)
+        return chat_completion_sync(message, model, system_prompt, history)
     except Exception as e:
         # Log the error for debugging
         print(f"OpenAI API Error: {e}")
         
         # Check if it's a quota error and provide fallback
-        if "quota_exceeded" in str(e) or "rate_limit" in str(e) or "quota" in str(e).lower() or "insufficient_quota" in str(e).lower():
+        if _is_quota_error(e):
+            upstream_errors.inc(provider="openai", error_class=classify_error(e))
+            mark("quota_fallback")  # Lets callers tell the canned reply from a real answer
             return get_fallback_response(message)
         else:
             # For other errors, still raise the exception with more specific info
             raise Exception(f"OpenAI API error: {str(e)}")
 
-def stream_chat_completion(message: str, model: str = DEFAULT_MODEL):
-    """Streaming chat completion"""
+async def chat_completion_with_fallback_async(message: str, model: str = DEFAULT_MODEL, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+    """Async chat completion with fallback response"""
     try:
-        max_tokens = int(os.getenv("OPENAI_MAX_TOKENS", "1000"))
-        temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
+        return await chat_completion_async(message, model, system_prompt, history)
+    except Exception as e:
+        print(f"OpenAI API Error: {e}")
         
-        stream = client.chat.completions.create(
+        if _is_quota_error(e):
+            upstream_errors.inc(provider="openai", error_class=classify_error(e))
+            mark("quota_fallback")  # Lets callers tell the canned reply from a real answer
+            return get_fallback_response(message)
+        else:
+            raise Exception(f"OpenAI API error: {str(e)}")
+
+async def stream_chat_completion(message: str, model: str = DEFAULT_MODEL, system_prompt: Optional[str] = None, history: Optional[list] = None, use_cache: bool = True, raise_errors: bool = False):
+    """Streaming chat completion (async generator over content deltas)
+
+    Errors become a short ErrorChunk unless raise_errors is set.
+    """
+    max_tokens, temperature = _generation_settings()
+    key = _cache_key(message, model, system_prompt, history, max_tokens, temperature, use_cache)
+    if key is not None:
+        cached = await _cached_answer_async(key, message)
+        if cached is not None:
+            # Replay as ordinary chunks so clients see the same protocol
+            for piece in iter_chunks(cached, REPLAY_CHUNK_CHARS):
+                yield piece
+            return
+    try:
+        stream = await get_async_client().chat.completions.create(
             model=model,
-            messages=[{"role": "user", "content": message}],
+            messages=_build_messages(message, system_prompt, history),
             max_tokens=max_tokens,
             temperature=temperature,
             stream=True
         )
+        mark("upstream_connect")
         
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
+        parts = []
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+            # Only answers that streamed to completion are cached
+            if key is not None:
+                _store_answer_async(key, message, "".join(parts))
+        finally:
+            # Release the pooled connection even if the consumer stops early
+            await stream.close()
                 
     except Exception as e:
+        if raise_errors:
+            raise
+        # Swallowed into a chunk below, so count it here
+        upstream_errors.inc(provider="openai", error_class=classify_error(e))
         # Super simple error handling - just basic messages
         error_msg = str(e).lower()
         
         # Check for specific issues and return ONE simple word/phrase
         if "520" in error_msg or "502" in error_msg or "503" in error_msg or "<!doctype" in error_msg:
-            yield "OpenAI is down"
+            yield ErrorChunk("OpenAI is down")
         elif "quota" in error_msg or "billing" in error_msg or "insufficient" in error_msg:
-            yield "Quota limit reached"
+            yield ErrorChunk("Quota limit reached")
         elif "rate limit" in error_msg or "429" in error_msg:
-            yield "Rate limit reached"
+            yield ErrorChunk("Rate limit reached")
         elif "401" in error_msg or "unauthorized" in error_msg or "api key" in error_msg:
-            yield "API key invalid"
+            yield ErrorChunk("API key invalid")
         else:
-            yield "Service unavailable"
\ No newline at end of file
+            yield ErrorChunk("Service unavailable")
+
+class OpenAIService:
+    """Async provider backed by the OpenAI chat completions API"""
+
+    def __init__(self, model: str = DEFAULT_MODEL, raise_errors: bool = False):
+        require_key()
+        self.model = model
+        self.raise_errors = raise_errors
+
+    async def warm_up(self):
+        """Import the client library and build the connection pool off the event loop"""
+        await asyncio.to_thread(get_async_client)
+
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Return the full answer, falling back to a canned reply on quota errors"""
+        return await chat_completion_with_fallback_async(message, self.model, system_prompt, history)
+
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None):
+        """Yield answer chunks as they arrive"""
+        stream = stream_chat_completion(message, self.model, system_prompt, history, raise_errors=self.raise_errors)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def request_key(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Key shared by identical requests (prompt, context and generation settings)"""
+        return request_key(message, self.model, system_prompt, history)
+
+    def check_status(self) -> bool:
+        """OpenAI is considered available when an API key is configured"""
+        return bool(OPENAI_KEY)
@@ -0,0 +1,38 @@
+"""
+Async provider interface shared by all AI backends
+Every backend exposes complete() and stream() coroutines so the API can await them on the event loop
+"""
+from typing import AsyncIterator, Optional, Protocol, runtime_checkable
+
+
+class ErrorChunk(str):
+    """A short error message yielded in place of answer text by providers that do not raise
+
+    Plain consumers still see a string; the WebSocket and SSE paths turn it into an error frame.
+    """
+
+
+@runtime_checkable
+class AsyncChatProvider(Protocol):
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Return the full answer for a message"""
+        ...
+
+    def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> AsyncIterator[str]:
+        """Yield the answer in chunks as they are produced"""
+        ...
+
+
+def build_prompt(message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+    """Flatten a system prompt, earlier turns and the user message for completion-style models"""
+    if history is None:
+        return f"{system_prompt}\n\nUser: {message}" if system_prompt else message
+    lines = [system_prompt, ""] if system_prompt else []
+    for turn in history:
+        if turn["role"] == "system":
+            lines.append(turn["content"])
+        else:
+            lines.append(f"{'User' if turn['role'] == 'user' else 'Assistant'}: {turn['content']}")
+    lines.append(f"User: {message}")
+    lines.append("Assistant:")
+    return "\n".join(lines)
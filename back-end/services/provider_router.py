@@ -0,0 +1,362 @@
+"""
+Latency-aware routing across several configured AI backends
+Each backend keeps an EWMA of its time to first token, an EWMA error rate and a
+circuit breaker. Requests go to the fastest healthy backend and fail over to the
+next one; with hedging enabled a second backend is started when the first has
+not produced anything by its p95 deadline, and whichever answers first wins.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Optional
+from .metrics import (classify_error, mark, set_provider, upstream_errors, upstream_request_duration, time_to_first_token,
+                      inter_token_latency, stream_tokens_per_second, stream_tokens)
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = self.CLOSED
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        """Closed circuits pass everything; a half-open circuit lets one trial request through"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        return state == self.HALF_OPEN and not self._trial_in_flight
+
+    def on_dispatch(self):
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = True
+
+    def release_trial(self):
+        """A request ended without an outcome (cancelled, or lost a hedge): let another trial through"""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self._state = self.CLOSED
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+
+class Backend:
+    def __init__(self, name: str, service, alpha: float = 0.2, window: int = 200,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.service = service
+        self.alpha = alpha
+        self.breaker = breaker or CircuitBreaker()
+        self.healthy: Optional[bool] = None  # Unknown until the first probe
+        self.last_probe = 0.0
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error_rate = 0.0
+        self._latencies: deque = deque(maxlen=window)
+
+        self.requests = 0
+        self.errors = 0
+        self.hedges_won = 0
+
+    def available(self) -> bool:
+        return self.healthy is not False and self.breaker.allow()
+
+    def observe_latency(self, latency: float):
+        self._latencies.append(latency)
+        self.ewma_latency = latency if self.ewma_latency is None else \
+            self.alpha * latency + (1 - self.alpha) * self.ewma_latency
+
+    def record_success(self, latency: Optional[float] = None):
+        self.requests += 1
+        if latency is not None:
+            self.observe_latency(latency)
+        self.ewma_error_rate *= 1 - self.alpha
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.ewma_error_rate = self.alpha + (1 - self.alpha) * self.ewma_error_rate
+        self.breaker.record_failure()
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def score(self, error_penalty: float) -> float:
+        """Expected latency inflated by the recent error rate; untried backends go first"""
+        return (self.ewma_latency or 0.0) * (1 + error_penalty * self.ewma_error_rate)
+
+    def stats(self) -> dict:
+        p95 = self.percentile(0.95)
+        return {
+            "name": self.name,
+            "service_type": type(self.service).__name__,
+            "healthy": self.healthy,
+            "circuit": self.breaker.state,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            "p95_latency_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(self.ewma_error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "hedges_won": self.hedges_won
+        }
+
+
+class _Attempt:
+    """One backend's stream, with its first chunk being fetched as a task"""
+
+    def __init__(self, backend: Backend, stream):
+        self.backend = backend
+        self.stream = stream
+        self.started = time.monotonic()
+        self.first = asyncio.ensure_future(stream.__anext__())
+
+    async def close(self):
+        try:
+            if not self.first.done():
+                self.first.cancel()
+            await asyncio.gather(self.first, return_exceptions=True)
+            await self.stream.aclose()
+        finally:
+            self.backend.breaker.release_trial()
+
+
+class ProviderRouter:
+    def __init__(self, backends: list, hedge_enabled: bool = False, hedge_min_delay: float = 0.05,
+                 hedge_max_delay: float = 2.0, hedge_min_samples: int = 20, error_penalty: float = 4.0,
+                 probe_interval: float = 15.0, probe_timeout: float = 5.0):
+        self.backends = backends
+        self.hedge_enabled = hedge_enabled
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.error_penalty = error_penalty
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._probe_task: Optional[asyncio.Task] = None
+
+        self.hedged_requests = 0
+        self.failovers = 0
+
+    def ranked(self) -> list:
+        """Available backends, fastest expected first"""
+        candidates = [b for b in self.backends if b.available()]
+        if not candidates:
+            raise RuntimeError("No healthy AI backend available")
+        return sorted(candidates, key=lambda b: b.score(self.error_penalty))
+
+    @staticmethod
+    def _failed(backend: Backend, error: Exception):
+        backend.record_failure()
+        upstream_errors.inc(provider=backend.name, error_class=classify_error(error))
+
+    def hedge_delay(self, backend: Backend) -> float:
+        """Wait this long for a first token before starting a second backend"""
+        if len(backend._latencies) < self.hedge_min_samples:
+            return self.hedge_max_delay
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, backend.percentile(0.95)))
+
+    async def complete(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+        """Full answer from the best backend, failing over to the next on errors"""
+        last_error = None
+        for i, backend in enumerate(self.ranked()):
+            if i:
+                self.failovers += 1
+            backend.breaker.on_dispatch()
+            started = time.monotonic()
+            try:
+                answer = await backend.service.complete(message, system_prompt, history)
+            except Exception as e:
+                self._failed(backend, e)
+                last_error = e
+                continue
+            finally:
+                # Cancelled requests record no outcome; without this a half-open circuit would stay shut
+                backend.breaker.release_trial()
+            elapsed = time.monotonic() - started
+            backend.record_success(elapsed)
+            upstream_request_duration.observe(elapsed, provider=backend.name, mode="complete")
+            set_provider(backend.name)
+            return answer
+        raise last_error
+
+    async def stream(self, message: str, system_prompt: Optional[str] = None, history: Optional[list] = None):
+        """Stream from the backend that produces a first token first
+
+        Backends are tried in rank order. A failure before the first token moves
+        on to the next backend; once tokens have been yielded errors propagate.
+        """
+        pending = self.ranked()
+        running = {}  # first-chunk task -> attempt
+        winner, latency, first_chunk, last_error = None, 0.0, None, None
+
+        def launch():
+            backend = pending.pop(0)
+            backend.breaker.on_dispatch()
+            attempt = _Attempt(backend, backend.service.stream(message, system_prompt, history))
+            running[attempt.first] = attempt
+            return attempt
+
+        primary = launch()
+        hedged = False
+        try:
+            while winner is None and running:
+                timeout = None
+                if self.hedge_enabled and pending and not hedged:
+                    timeout = max(0.0, primary.started + self.hedge_delay(primary.backend) - time.monotonic())
+                done, _ = await asyncio.wait(list(running), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedged_requests += 1
+                    launch()
+                    continue
+                for task in done:
+                    attempt = running.pop(task)
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner, latency = attempt, time.monotonic() - attempt.started
+                        first_chunk = None if error else task.result()
+                        break
+                    self._failed(attempt.backend, error)
+                    last_error = error
+                    await attempt.stream.aclose()
+                if winner is None and not running and pending:
+                    self.failovers += 1
+                    primary = launch()
+        finally:
+            # Losing (or abandoned) attempts are cancelled and their upstreams closed
+            for attempt in running.values():
+                if winner is not None:
+                    # A hedge loser took at least this long; without it a slow backend would never be measured
+                    attempt.backend.observe_latency(time.monotonic() - attempt.started)
+                await attempt.close()
+
+        if winner is None:
+            raise last_error
+        name = winner.backend.name
+        # Only the latency counts now; whether the request succeeded is known once the stream ends
+        winner.backend.observe_latency(latency)
+        time_to_first_token.observe(latency, provider=name)
+        mark("first_token")
+        set_provider(name)
+        if hedged and winner is not primary:
+            winner.backend.hedges_won += 1
+
+        try:
+            if first_chunk is not None:
+                yield first_chunk
+                count, first_at = 1, time.monotonic()
+                previous = first_at
+                async for chunk in winner.stream:
+                    now = time.monotonic()
+                    inter_token_latency.observe(now - previous, provider=name)
+                    previous = now
+                    count += 1
+                    yield chunk
+                stream_tokens.inc(count, provider=name)
+                upstream_request_duration.observe(previous - winner.started, provider=name, mode="stream")
+                if count > 1 and previous > first_at:
+                    stream_tokens_per_second.observe((count - 1) / (previous - first_at), provider=name)
+        except Exception as e:
+            self._failed(winner.backend, e)
+            raise
+        else:
+            winner.backend.record_success()
+        finally:
+            # A consumer that leaves mid-stream records no outcome
+            winner.backend.breaker.release_trial()
+            await winner.stream.aclose()
+
+    async def probe(self, backend: Backend):
+        """Check one backend now, e.g. as it is added, instead of waiting for the next probe round"""
+        await self._probe(backend)
+
+    async def _probe(self, backend: Backend):
+        service = backend.service
+        try:
+            if hasattr(service, "check_status_async"):
+                healthy = await asyncio.wait_for(service.check_status_async(), self.probe_timeout)
+            elif hasattr(service, "check_status"):
+                healthy = await asyncio.wait_for(asyncio.to_thread(service.check_status), self.probe_timeout)
+            else:
+                healthy = True
+        except Exception:
+            healthy = False
+        backend.healthy = bool(healthy)
+        backend.last_probe = time.time()
+
+    async def probe_all(self):
+        await asyncio.gather(*(self._probe(b) for b in self.backends))
+
+    async def _probe_loop(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self):
+        """Start background health probing (call from a running event loop)"""
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+
+    def stats(self) -> dict:
+        return {
+            "hedging_enabled": self.hedge_enabled,
+            "hedged_requests": self.hedged_requests,
+            "failovers": self.failovers,
+            "backends": [b.stats() for b in self.backends]
+        }
+
+
+def backend_from_env(name: str, service) -> Backend:
+    return Backend(
+        name,
+        service,
+        alpha=float(os.getenv("ROUTER_EWMA_ALPHA", "0.2")),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv("ROUTER_BREAKER_FAILURES", "5")),
+            reset_timeout=float(os.getenv("ROUTER_BREAKER_RESET_SECONDS", "30"))
+        )
+    )
+
+
+def router_from_env(backends: list) -> ProviderRouter:
+    """Router over backends (the list may keep growing as providers finish warming up)"""
+    return ProviderRouter(
+        backends,
+        hedge_enabled=os.getenv("ROUTER_HEDGING_ENABLED", "false").lower() == "true",
+        hedge_min_delay=float(os.getenv("ROUTER_HEDGE_MIN_MS", "50")) / 1000,
+        hedge_max_delay=float(os.getenv("ROUTER_HEDGE_MAX_MS", "2000")) / 1000,
+        hedge_min_samples=int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", "20")),
+        error_penalty=float(os.getenv("ROUTER_ERROR_PENALTY", "4")),
+        probe_interval=float(os.getenv("ROUTER_PROBE_INTERVAL_SECONDS", "15")),
+        probe_timeout=float(os.getenv("ROUTER_PROBE_TIMEOUT_SECONDS", "5"))
+    )
@@ -0,0 +1,154 @@
+"""
+Replay buffers for resumable WebSocket answers
+Each generation writes its frames to a buffer keyed by a random request id instead
+of straight to the socket, so it can keep running for a while after the client
+drops. A client that reconnects sends the request id and the number of frames it
+already has, and gets the missed frames followed by the live tail, so a flaky
+connection does not cost a second upstream call. Buffers are capped in size and number and expire a
+TTL after their generation ends.
+"""
+import asyncio
+import os
+import secrets
+import time
+from collections import OrderedDict
+from typing import Optional
+from .metrics import generations_cancelled
+
+
+class ReplayGap(Exception):
+    """The requested frames were already dropped from the buffer"""
+
+
+class ReplayBuffer:
+    def __init__(self, request_id: str, max_chars: int = 65536, owner=None):
+        self.request_id = request_id
+        self.max_chars = max_chars
+        self.owner = owner  # The conversation the answer belongs to, handed to whoever resumes it
+        self.frames: list = []
+        self.base = 0  # Offset of frames[0]; earlier frames were dropped to stay under max_chars
+        self.chars = 0
+        self.done = False
+        self.error: Optional[dict] = None
+        self.timing = None
+        self.task: Optional[asyncio.Task] = None  # The generation filling the buffer
+        self.followers = 0  # Sockets currently sending this answer
+        self.finished_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def end(self) -> int:
+        """Offset just past the last frame"""
+        return self.base + len(self.frames)
+
+    def _wake(self):
+        # Followers wait on the old event; a fresh one is armed for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append(self, frame: str):
+        self.frames.append(frame)
+        self.chars += len(frame)
+        while self.chars > self.max_chars and len(self.frames) > 1:
+            self.chars -= len(self.frames.pop(0))
+            self.base += 1
+        self._wake()
+
+    def finish(self, error: Optional[dict] = None):
+        self.done = True
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._wake()
+
+    async def follow(self, offset: int = 0):
+        """Frames from offset on: the buffered ones, then live ones until the generation ends"""
+        self.followers += 1
+        try:
+            while True:
+                if offset < self.base:
+                    raise ReplayGap(f"Frames before {self.base} are no longer buffered")
+                if offset < self.end:
+                    frame = self.frames[offset - self.base]
+                    offset += 1
+                    yield frame
+                    continue
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.followers -= 1
+
+
+class ReplayStore:
+    def __init__(self, ttl: float = 60, max_streams: int = 1000, max_chars: int = 65536, enabled: bool = True):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.max_chars = max_chars
+        self.enabled = enabled
+        self._buffers: OrderedDict = OrderedDict()  # request id -> buffer, oldest first
+
+        self.created = 0
+        self.resumed = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def _expire(self, now: float):
+        for request_id, buffer in list(self._buffers.items()):
+            if buffer.done and now - buffer.finished_at > self.ttl:
+                del self._buffers[request_id]
+                self.expired += 1
+
+    def create(self, owner=None) -> ReplayBuffer:
+        """A buffer for a new generation; not registered (so not resumable) when replay is disabled"""
+        buffer = ReplayBuffer(secrets.token_urlsafe(12), self.max_chars, owner)
+        self.created += 1
+        if not self.enabled:
+            return buffer
+        self._expire(time.monotonic())
+        self._buffers[buffer.request_id] = buffer
+        while len(self._buffers) > self.max_streams:
+            self._evict()
+        return buffer
+
+    def _evict(self):
+        """Drop the oldest finished buffer, or if every one is live, the oldest and its generation"""
+        request_id = next((key for key, buffer in self._buffers.items() if buffer.done), None)
+        if request_id is None:
+            request_id = next(iter(self._buffers))
+        buffer = self._buffers.pop(request_id)
+        self.evicted += 1
+        if buffer.task is not None and not buffer.task.done():
+            # It can no longer be resumed; stop it so its upstream stream and admission slot are freed
+            buffer.task.cancel()
+            generations_cancelled.inc(reason="evicted")
+
+    def get(self, request_id: str) -> Optional[ReplayBuffer]:
+        self._expire(time.monotonic())
+        buffer = self._buffers.get(request_id)
+        if buffer is None:
+            self.misses += 1
+        else:
+            self.resumed += 1
+        return buffer
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "streams": len(self._buffers),
+            "live": sum(1 for b in self._buffers.values() if not b.done),
+            "buffered_chars": sum(b.chars for b in self._buffers.values()),
+            "created": self.created,
+            "resumed": self.resumed,
+            "misses": self.misses,
+            "evicted": self.evicted,
+            "expired": self.expired
+        }
+
+
+replay_store = ReplayStore(
+    ttl=float(os.getenv("WS_REPLAY_TTL_SECONDS", "60")),
+    max_streams=int(os.getenv("WS_REPLAY_MAX_STREAMS", "1000")),
+    max_chars=int(os.getenv("WS_REPLAY_MAX_CHARS", "65536")),
+    enabled=os.getenv("WS_REPLAY_ENABLED", "true").lower() == "true"
+)
@@ -0,0 +1,219 @@
+"""
+Response cache for chat completions
+Bounded in-memory LRU with a TTL, plus an optional SQLite tier that survives restarts.
+The async API keeps only the in-memory LRU on the event loop: disk reads run in a
+worker thread and disk writes are handed to a single writer thread.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+
+def normalize_prompt(message: str) -> str:
+    """Lowercase and collapse whitespace so trivially different prompts share a key"""
+    return re.sub(r"\s+", " ", message.strip().lower())
+
+
+def make_cache_key(message: str, model: str, temperature: float, max_tokens: int,
+                   system_prompt: Optional[str] = None, history: Optional[list] = None) -> str:
+    """Stable key for a request's prompt, conversation context and generation settings"""
+    raw = json.dumps([normalize_prompt(message), model, temperature, max_tokens, system_prompt or "", history or []])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def iter_chunks(text: str, size: int):
+    """Split a cached answer into stream-sized chunks for replay"""
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 disk_path: Optional[str] = None, disk_max_entries: int = 100000,
+                 cache_sampled: bool = True):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_max_entries = disk_max_entries
+        self.cache_sampled = cache_sampled
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        # The sync completion path runs in worker threads, so guard the shared state
+        self._lock = threading.Lock()
+        # The SQLite connection has its own lock so memory lookups never wait on disk I/O
+        self._disk_lock = threading.Lock()
+        self._disk_writer: Optional[ThreadPoolExecutor] = None
+        self._db = None
+        self._writes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.disk_hits = 0
+
+        if disk_path:
+            self._open_disk(disk_path)
+
+    def _open_disk(self, path: str):
+        """Open (or create) the on-disk tier"""
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Response cache disk tier disabled: {e}")
+            self._db = None
+
+    def should_cache(self, temperature: float) -> bool:
+        """Sampled requests (temperature > 0) are only cached when allowed"""
+        return self.cache_sampled or temperature <= 0
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached answer or None (blocks on the disk tier; use aget on the event loop)"""
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is None and self._db is not None:
+            value = self._disk_get(key, now)
+        return self._count(key, value, now)
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Like get, with the disk lookup run in a worker thread"""
+        now = time.time()
+        value = self._memory_get(key, now)
+        if value is None and self._db is not None:
+            value = await asyncio.to_thread(self._disk_get, key, now)
+        return self._count(key, value, now)
+
+    def set(self, key: str, value: str):
+        """Store an answer in memory and, if enabled, on disk"""
+        if not value:
+            return
+        now = time.time()
+        with self._lock:
+            self._memory_set(key, value, now)
+        self._disk_set(key, value, now)
+
+    def set_nowait(self, key: str, value: str):
+        """Store an answer in memory now; the disk write is queued on the writer thread"""
+        if not value:
+            return
+        now = time.time()
+        with self._lock:
+            self._memory_set(key, value, now)
+        if self._db is not None:
+            if self._disk_writer is None:
+                self._disk_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache-writer")
+            self._disk_writer.submit(self._disk_set, key, value, now)
+
+    def _memory_get(self, key: str, now: float) -> Optional[str]:
+        """Memory-tier value, or None; counts only expirations"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at > now:
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+            self.expirations += 1
+            return None
+
+    def _count(self, key: str, value: Optional[str], now: float) -> Optional[str]:
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if key not in self._entries:
+                # Found on disk: promote to memory
+                self.disk_hits += 1
+                self._memory_set(key, value, now)
+            return value
+
+    def _memory_set(self, key: str, value: str, now: float):
+        self._entries[key] = (now + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _disk_get(self, key: str, now: float) -> Optional[str]:
+        if self._db is None:
+            return None
+        try:
+            with self._disk_lock:
+                row = self._db.execute(
+                    "SELECT value FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error:
+            return None
+
+    def _disk_set(self, key: str, value: str, now: float):
+        if self._db is None:
+            return
+        try:
+            with self._disk_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, expires_at, created_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now + self.ttl_seconds, now)
+                )
+                self._writes += 1
+                # Prune periodically rather than on every write
+                if self._writes % 100 == 0:
+                    self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                    self._db.execute(
+                        "DELETE FROM responses WHERE key IN ("
+                        "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                        (self.disk_max_entries,)
+                    )
+                self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Response cache disk write failed: {e}")
+
+    def clear(self):
+        """Drop every cached answer"""
+        with self._lock:
+            self._entries.clear()
+        if self._db is not None:
+            with self._disk_lock:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+REPLAY_CHUNK_CHARS = int(os.getenv("RESPONSE_CACHE_REPLAY_CHUNK_CHARS", "16"))
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")),
+    ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+    disk_path=os.getenv("RESPONSE_CACHE_DISK_PATH") or None,
+    disk_max_entries=int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "100000")),
+    cache_sampled=os.getenv("RESPONSE_CACHE_SAMPLED", "true").lower() == "true"
+)
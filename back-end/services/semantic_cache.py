@@ -0,0 +1,287 @@
+"""
+Semantic cache for near-duplicate prompts
+Prompts are turned into signed feature-hashing vectors and kept in an int8 NumPy matrix,
+so "what is zbot?" and "what's ZBot" can share one stored answer without an upstream call.
+Entries the quantized scan puts near the threshold are re-scored with their exact vectors.
+Requires numpy (pip install numpy); the cache is disabled when it is missing.
+"""
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Optional
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+_CONTRACTIONS = [
+    ("what's", "what is"), ("who's", "who is"), ("it's", "it is"), ("that's", "that is"),
+    ("won't", "will not"), ("can't", "can not"), ("n't", " not"), ("'re", " are"),
+    ("'m", " am"), ("'ll", " will"), ("'ve", " have"), ("'d", " would"), ("'s", " is"),
+]
+
+# Function words still count, but far less than content words
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "am", "was", "were", "be", "do", "does", "did", "of", "to",
+    "in", "on", "for", "and", "or", "me", "my", "i", "you", "your", "it", "this", "that",
+    "can", "could", "would", "will", "please", "tell", "about",
+}
+_STOPWORD_WEIGHT = 0.25
+_SCALE = 127  # Stored weights are rounded to multiples of 1/_SCALE
+_BIGRAM_WEIGHT = 0.5
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def _stem(word: str) -> str:
+    """Very light plural stripping"""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(message: str) -> list:
+    """Lowercase, expand contractions and split into stemmed words"""
+    text = message.lower().replace("’", "'")
+    for short, full in _CONTRACTIONS:
+        text = text.replace(short, full)
+    return [_stem(w) for w in _WORD_RE.findall(text)]
+
+
+def make_scope(model: str, temperature: float, max_tokens: int, system_prompt: Optional[str] = None) -> int:
+    """Answers are only shared between requests with the same generation settings"""
+    return zlib.crc32(json.dumps([model, temperature, max_tokens, system_prompt or ""]).encode("utf-8"))
+
+
+class HashingVectorizer:
+    """Signed feature hashing of unigrams and bigrams into a fixed number of dimensions"""
+
+    def __init__(self, dim: int = 256, max_features: int = 12):
+        self.dim = dim
+        self.max_features = max_features
+
+    def _add(self, features: dict, token: str, weight: float):
+        h = zlib.crc32(token.encode("utf-8"))
+        index = h % self.dim
+        sign = 1.0 if (h >> 31) & 1 else -1.0
+        features[index] = features.get(index, 0.0) + sign * weight
+
+    def sparse(self, message: str):
+        """Return (indices, values) of the L2-normalised vector
+
+        Only the max_features strongest features are kept, so every stored
+        vector and every query touches a small, fixed number of matrix rows.
+        """
+        words = tokenize(message)
+        features: dict = {}
+        for word in words:
+            self._add(features, word, _STOPWORD_WEIGHT if word in _STOPWORDS else 1.0)
+        for first, second in zip(words, words[1:]):
+            self._add(features, f"{first} {second}", _BIGRAM_WEIGHT)
+
+        if len(features) > self.max_features:
+            # Ties are broken by index so paraphrases keep the same features
+            strongest = sorted(features.items(), key=lambda item: (-abs(item[1]), item[0]))
+            features = dict(strongest[:self.max_features])
+        indices = np.fromiter(features.keys(), dtype=np.intp, count=len(features))
+        values = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+        norm = float(np.linalg.norm(values)) if len(values) else 0.0
+        if norm == 0.0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        return indices, values / norm
+
+
+class SemanticCache:
+    def __init__(self, max_entries: int = 10000, dim: int = 256, threshold: float = 0.9,
+                 ttl_seconds: float = 3600, max_features: int = 12):
+        if not NUMPY_AVAILABLE:
+            raise ImportError("numpy not installed. Run: pip install numpy")
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.vectorizer = HashingVectorizer(dim, max_features)
+
+        # Column-major: each feature is one contiguous row, so a sparse query only
+        # reads the few rows it has non-zero weights for instead of the whole matrix.
+        # Weights are stored as int8 (scaled by _SCALE), which cuts the memory read
+        # per lookup to a quarter of float32; scores accumulate exactly in int16.
+        self._codes = np.zeros((dim, max_entries), dtype=np.int8)
+        # The exact vectors, as up to max_features (index, weight) pairs per entry,
+        # re-score the few entries the int8 scan puts near the threshold
+        self._features = np.zeros((max_entries, max_features), dtype=np.intp)
+        self._weights = np.zeros((max_entries, max_features), dtype=np.float32)
+        # Rounding both vectors to 1/_SCALE moves a score by at most this much
+        step = 0.5 / _SCALE
+        self._margin = 2 * step * max_features ** 0.5 + max_features * step * step
+        self._scope = np.zeros(max_entries, dtype=np.int64)
+        self._expires_at = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._answers: list = [None] * max_entries
+        self._scores = np.empty(max_entries, dtype=np.int16)
+        self._scratch = np.empty(max_entries, dtype=np.int16)
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _approximate(self, indices, values):
+        """Similarity of the query against every stored vector, in units of 1/_SCALE**2
+
+        Both vectors have unit norm, so the sum stays within int16 range.
+        """
+        n = self._size
+        query = np.rint(values * _SCALE).astype(np.int16)
+        scores = self._scores[:n]
+        scratch = self._scratch[:n]
+        np.multiply(self._codes[indices[0], :n], query[0], out=scores, dtype=np.int16)
+        for i in range(1, len(indices)):
+            np.multiply(self._codes[indices[i], :n], query[i], out=scratch, dtype=np.int16)
+            scores += scratch
+        return scores
+
+    def _exact(self, slots, indices, values):
+        """Cosine similarity of the query against the given slots"""
+        query = np.zeros(self.vectorizer.dim, dtype=np.float32)
+        query[indices] = values
+        return (query[self._features[slots]] * self._weights[slots]).sum(axis=1)
+
+    def _valid(self, slots, scope: Optional[int], now: float):
+        """Drop expired slots and slots stored under different generation settings"""
+        keep = self._expires_at[slots] > now
+        if scope is not None:
+            keep &= self._scope[slots] == scope
+        return slots[keep]
+
+    def _top_k(self, indices, values, k: int, scope: Optional[int], now: float,
+               min_score: Optional[float] = None) -> list:
+        if self._size == 0 or len(indices) == 0:
+            return []
+        scores = self._approximate(indices, values)
+        if min_score is not None:
+            # Hot path: only the few entries that may be above the threshold are considered
+            cutoff = int(np.floor((min_score - self._margin) * _SCALE * _SCALE))
+            slots = np.flatnonzero(scores >= max(cutoff, -32768))
+        else:
+            count = min(k * 4, self._size)
+            slots = np.argpartition(scores, -count)[-count:]
+        slots = self._valid(slots, scope, now)
+        exact = self._exact(slots, indices, values)
+        if min_score is not None:
+            keep = exact >= min_score
+            slots, exact = slots[keep], exact[keep]
+        best = np.argsort(-exact)[:k]
+        return [(float(exact[i]), int(slots[i])) for i in best]
+
+    def top_k(self, message: str, k: int = 1, scope: Optional[int] = None) -> list:
+        """Return up to k (similarity, answer) pairs, best first"""
+        indices, values = self.vectorizer.sparse(message)
+        with self._lock:
+            best = self._top_k(indices, values, k, scope, time.time())
+            return [(score, self._answers[slot]) for score, slot in best]
+
+    def lookup(self, message: str, scope: Optional[int] = None) -> Optional[str]:
+        """Stored answer for the most similar prompt above the threshold, or None"""
+        indices, values = self.vectorizer.sparse(message)
+        now = time.time()
+        with self._lock:
+            best = self._top_k(indices, values, 1, scope, now, self.threshold)
+            if best:
+                slot = best[0][1]
+                self._last_used[slot] = now
+                self.hits += 1
+                return self._answers[slot]
+            self.misses += 1
+            return None
+
+    def add(self, message: str, answer: str, scope: Optional[int] = None, dedupe: bool = True):
+        """Index an answer; a near-identical prompt overwrites its existing slot"""
+        if not answer:
+            return
+        indices, values = self.vectorizer.sparse(message)
+        if len(indices) == 0:
+            return
+        now = time.time()
+        with self._lock:
+            best = self._top_k(indices, values, 1, scope, now, 0.999) if dedupe else []
+            slot = best[0][1] if best else self._free_slot(now)
+            self._codes[self._features[slot], slot] = 0  # Only the previous entry's features are non-zero
+            self._codes[indices, slot] = np.rint(values * _SCALE)
+            self._features[slot] = 0
+            self._weights[slot] = 0.0
+            self._features[slot, :len(indices)] = indices
+            self._weights[slot, :len(indices)] = values
+            self._scope[slot] = scope or 0
+            self._expires_at[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
+            self._answers[slot] = answer
+
+    def _free_slot(self, now: float) -> int:
+        """Next empty slot, else an expired one, else the least recently used"""
+        if self._size < self.max_entries:
+            self._size += 1
+            return self._size - 1
+        expired = np.flatnonzero(self._expires_at[:self._size] <= now)
+        if len(expired):
+            return int(expired[0])
+        self.evictions += 1
+        return int(np.argmin(self._last_used[:self._size]))
+
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    if NUMPY_AVAILABLE:
+        semantic_cache = SemanticCache(
+            max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000")),
+            dim=int(os.getenv("SEMANTIC_CACHE_DIM", "256")),
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9")),
+            ttl_seconds=float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "3600"))
+        )
+    else:
+        print("Semantic cache disabled: numpy not installed. Run: pip install numpy")
+
+
+if __name__ == "__main__":
+    # Lookup latency benchmark: python -m services.semantic_cache [entries]
+    import random
+    import sys
+
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    vocab = [f"word{i}" for i in range(5000)]
+    cache = SemanticCache(max_entries=entries)
+    for i in range(entries):
+        cache.add(" ".join(random.choices(vocab, k=random.randint(4, 20))), f"answer {i}", dedupe=False)
+    cache.add("what is zbot?", "ZBot is an AI assistant.")
+
+    print("what's ZBot ->", cache.lookup("what's ZBot"))
+    timings = []
+    for _ in range(1000):
+        prompt = " ".join(random.choices(vocab, k=random.randint(4, 20)))
+        start = time.perf_counter()
+        cache.lookup(prompt)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    print(f"{entries} entries: p50 {timings[500] * 1e3:.3f} ms, p99 {timings[990] * 1e3:.3f} ms")
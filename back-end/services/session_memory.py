@@ -0,0 +1,126 @@
+"""
+Per-connection conversation memory
+Turns are stored with their token counts (counted once, when added), and older
+turns are folded into a short summary so the context always fits a token budget.
+"""
+import os
+import re
+from collections import deque
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+_APPROX_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+# Chat formats add a few tokens of framing per message
+_MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """Load the tokenizer once per process"""
+    if TIKTOKEN_AVAILABLE:
+        try:
+            return tiktoken.get_encoding(os.getenv("SESSION_TOKENIZER", "cl100k_base"))
+        except Exception as e:
+            print(f"tiktoken unavailable, approximating token counts: {e}")
+    return None
+
+
+def count_tokens(text: str) -> int:
+    """Token count with the cached tokenizer, or a word/punctuation estimate"""
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(_APPROX_TOKEN_RE.findall(text))
+
+
+def _first_sentence(text: str, limit: int = 120) -> str:
+    sentence = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit].rstrip() + "..."
+
+
+class ChatSession:
+    def __init__(self, token_budget: int = 2000, summary_budget: int = 200):
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self._turns: deque = deque()  # (role, content, tokens)
+        self._turn_tokens = 0
+        self._summary_points: deque = deque()  # (text, tokens)
+        self._summary_tokens = 0
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def add(self, role: str, content: str):
+        """Append a turn and compact the history if it no longer fits"""
+        if not content:
+            return
+        tokens = count_tokens(content) + _MESSAGE_OVERHEAD
+        self._turns.append((role, content, tokens))
+        self._turn_tokens += tokens
+        self._compact()
+
+    def add_user(self, content: str):
+        self.add("user", content)
+
+    def add_assistant(self, content: str):
+        self.add("assistant", content)
+
+    def clear(self):
+        self._turns.clear()
+        self._turn_tokens = 0
+        self._summary_points.clear()
+        self._summary_tokens = 0
+
+    def _compact(self):
+        """Fold the oldest turns into the summary until the history fits the budget"""
+        while self._turns and self._turn_tokens + self._summary_tokens > self.token_budget:
+            role, content, tokens = self._turns.popleft()
+            self._turn_tokens -= tokens
+            if role == "user":
+                point = _first_sentence(content)
+                point_tokens = count_tokens(point) + 1
+                self._summary_points.append((point, point_tokens))
+                self._summary_tokens += point_tokens
+            # The summary itself is bounded: drop its oldest points first
+            while self._summary_points and self._summary_tokens > self.summary_budget:
+                _, dropped = self._summary_points.popleft()
+                self._summary_tokens -= dropped
+
+    @property
+    def summary(self) -> Optional[str]:
+        if not self._summary_points:
+            return None
+        return "Earlier in this conversation the user asked about: " + "; ".join(point for point, _ in self._summary_points)
+
+    def context(self, reserve_tokens: int = 0) -> list:
+        """Chat messages for the next request, newest turns kept within budget - reserve_tokens"""
+        budget = self.token_budget - reserve_tokens - self._summary_tokens
+        selected = []
+        for role, content, tokens in reversed(self._turns):
+            if tokens > budget:
+                break
+            selected.append({"role": role, "content": content})
+            budget -= tokens
+        selected.reverse()
+        summary = self.summary
+        if summary:
+            selected.insert(0, {"role": "system", "content": summary})
+        return selected
+
+    def token_count(self) -> int:
+        return self._turn_tokens + self._summary_tokens
+
+
+SESSION_MEMORY_ENABLED = os.getenv("SESSION_MEMORY_ENABLED", "true").lower() == "true"
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "2000"))
+SESSION_SUMMARY_BUDGET = int(os.getenv("SESSION_SUMMARY_BUDGET", "200"))
+
+
+def new_session() -> ChatSession:
+    return ChatSession(token_budget=SESSION_TOKEN_BUDGET, summary_budget=SESSION_SUMMARY_BUDGET)
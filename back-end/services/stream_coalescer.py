@@ -0,0 +1,108 @@
+"""
+Single-flight coalescing for streamed completions
+Identical concurrent requests share one upstream stream; every subscriber gets
+a replay of the chunks produced so far and then follows the live tail.
+"""
+import asyncio
+import os
+
+
+class _Flight:
+    """One upstream generation and the chunks it has produced"""
+
+    def __init__(self):
+        self.chunks: list = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Exception = None):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        # Wake everyone waiting on the current event and start a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        """Replay buffered chunks, then yield new ones until the flight ends"""
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class StreamCoalescer:
+    def __init__(self):
+        self._flights: dict = {}
+        self.requests = 0
+        self.upstream_streams = 0
+
+    async def stream(self, key: str, factory):
+        """Yield chunks for key, starting factory() only if no identical stream is in flight"""
+        self.requests += 1
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            self.upstream_streams += 1
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+
+        flight.subscribers += 1
+        try:
+            async for chunk in flight.follow():
+                yield chunk
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is listening any more: stop paying for upstream tokens
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def _run(self, key: str, flight: _Flight, factory):
+        error = None
+        stream = factory()
+        try:
+            async for chunk in stream:
+                flight.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            self._forget(key, flight)
+            flight.finish(error)
+            # Also when cancelled, so the provider closes its upstream request right away
+            await stream.aclose()
+
+    def _forget(self, key: str, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        """How many requests were served by an already running stream"""
+        coalesced = self.requests - self.upstream_streams
+        return {
+            "in_flight": len(self._flights),
+            "requests": self.requests,
+            "upstream_streams": self.upstream_streams,
+            "coalesced": coalesced,
+            "coalescing_ratio": coalesced / self.requests if self.requests else 0.0
+        }
+
+
+COALESCING_ENABLED = os.getenv("STREAM_COALESCING_ENABLED", "true").lower() == "true"
+
+stream_coalescer = StreamCoalescer()
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+
+from services import admission
+from services.admission import client_id_from, parse_networks
+
+
+def test_proxy_headers_from_an_untrusted_peer_are_ignored(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXIES", parse_networks("10.0.0.0/8"))
+    peer = SimpleNamespace(host="203.0.113.7")
+    for spoofed in ({"x-real-ip": "198.51.100.1"}, {"x-forwarded-for": "198.51.100.2"}):
+        assert client_id_from(spoofed, peer) == "203.0.113.7"
+
+
+def test_proxy_headers_are_ignored_by_default():
+    assert admission.TRUSTED_PROXIES == []
+    assert client_id_from({"x-real-ip": "198.51.100.1"}, SimpleNamespace(host="203.0.113.7")) == "203.0.113.7"
+
+
+def test_trusted_proxy_forwards_the_client_address(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXIES", parse_networks("10.0.0.0/8, 127.0.0.1"))
+    proxy = SimpleNamespace(host="10.1.2.3")
+    assert client_id_from({"x-real-ip": "198.51.100.1"}, proxy) == "198.51.100.1"
+    # The client's own X-Forwarded-For entry is skipped; the hop our proxy appended is used
+    assert client_id_from({"x-forwarded-for": "1.1.1.1, 198.51.100.3"}, proxy) == "198.51.100.3"
+    assert client_id_from({"x-forwarded-for": "198.51.100.4, 127.0.0.1"}, proxy) == "198.51.100.4"
+    assert client_id_from({}, None) == "unknown"
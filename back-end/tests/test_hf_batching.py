@@ -0,0 +1,100 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from services.hf_batching import BatchingEngine
+from services.huggingface_service import HuggingFaceService
+
+
+class CharTokenizer:
+    """One token per byte, id 0 as end of text"""
+    eos_token = "<eos>"
+    eos_token_id = 0
+
+    def __init__(self):
+        self.padding_side = "right"
+        self.pad_token = None
+
+    @property
+    def pad_token_id(self):
+        return 0
+
+    def __call__(self, texts, return_tensors="pt", padding=True):
+        texts = [texts] if isinstance(texts, str) else texts
+        rows = [[b + 1 for b in text.encode("utf-8")] for text in texts]
+        width = max(len(row) for row in rows)
+        ids = [[0] * (width - len(row)) + row for row in rows]
+        mask = [[0] * (width - len(row)) + [1] * len(row) for row in rows]
+        return transformers.BatchEncoding({"input_ids": torch.tensor(ids), "attention_mask": torch.tensor(mask)})
+
+    def decode(self, ids, skip_special_tokens=True):
+        ids = ids.tolist() if hasattr(ids, "tolist") else ids
+        return bytes(i - 1 for i in ids if 0 < i <= 128).decode("utf-8", errors="replace")
+
+
+def make_engine(**kwargs):
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=257, n_positions=128, n_embd=32, n_layer=2, n_head=2,
+                                     eos_token_id=0, bos_token_id=0)
+    model = transformers.GPT2LMHeadModel(config).eval()
+    return BatchingEngine(model, CharTokenizer(), max_wait_ms=200, do_sample=False, **kwargs)
+
+
+def test_streams_share_a_batch_and_receive_their_own_text():
+    engine = make_engine()
+    pieces = {0: [], 1: []}
+    futures = [engine.submit(f"prompt {i}", 20, on_text=pieces[i].append) for i in range(2)]
+    futures.append(engine.submit("plain", 20))
+    texts = [future.result(timeout=60) for future in futures]
+    engine.close()
+
+    assert engine.stats()["batches"] == 1
+    for i in range(2):
+        assert len(pieces[i]) > 1
+        assert "".join(pieces[i]).strip() == texts[i]
+
+
+def test_stopping_one_stream_leaves_the_rest_of_the_batch_running():
+    engine = make_engine()
+    stop = threading.Event()
+    pieces = []
+
+    def on_text(text):
+        pieces.append(text)
+        stop.set()
+
+    stopped = engine.submit("stop me", 30, on_text=on_text, stop=stop)
+    other = engine.submit("keep going", 30)
+    stopped_text, other_text = stopped.result(timeout=60), other.result(timeout=60)
+    engine.close()
+
+    assert len(pieces) == 1
+    assert len(stopped_text) < len(other_text)
+
+
+def test_complete_and_stream_send_the_same_prompt():
+    class RecordingEngine:
+        def __init__(self):
+            self.prompts = []
+
+        def submit(self, prompt, max_new_tokens=100, on_text=None, stop=None):
+            self.prompts.append(prompt)
+            future = Future()
+            future.set_result("answer")
+            return future
+
+    async def run(model_name):
+        service = HuggingFaceService(model_name)
+        service.engine, service.tokenizer = RecordingEngine(), CharTokenizer()
+        await service.complete("hi", "Be brief.")
+        [chunk async for chunk in service.stream("hi", "Be brief.")]
+        return service.engine.prompts
+
+    for model_name in ("gpt2", "microsoft/DialoGPT-medium"):
+        first, second = asyncio.run(run(model_name))
+        assert first == second
@@ -0,0 +1,50 @@
+import asyncio
+
+from services import ollama_service
+from services.multi_provider_service import MultiProviderAIService
+
+
+def test_ollama_endpoints_that_are_down_at_startup_join_once_probes_succeed(monkeypatch):
+    monkeypatch.setenv("AI_PROVIDERS", "ollama")
+    monkeypatch.setenv("OLLAMA_ENDPOINTS", "http://ollama-a:11434,http://ollama-b:11434")
+    up = set()
+
+    async def check_status_async(self):
+        return self.base_url in up
+
+    monkeypatch.setattr(ollama_service.OllamaService, "check_status_async", check_status_async)
+
+    async def scenario():
+        service = MultiProviderAIService()
+        await service.warm_up()
+        assert [b.name for b in service.backends] == ["ollama@http://ollama-a:11434", "ollama@http://ollama-b:11434"]
+        assert [b.healthy for b in service.backends] == [False, False]
+
+        up.add("http://ollama-b:11434")
+        await service.router.probe_all()
+        assert [b.available() for b in service.backends] == [False, True]
+        await service.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_request_key_is_the_same_before_and_after_warm_up(monkeypatch):
+    monkeypatch.setenv("AI_PROVIDERS", "ollama")
+    monkeypatch.setenv("OLLAMA_ENDPOINTS", "http://ollama-a:11434")
+
+    async def check_status_async(self):
+        return True
+
+    monkeypatch.setattr(ollama_service.OllamaService, "check_status_async", check_status_async)
+
+    async def scenario():
+        service = MultiProviderAIService()
+        before = service.request_key("hello", None, None)
+        await service.warm_up()
+        after = service.request_key("hello", None, None)
+        await service.aclose()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    assert before == after
+    assert MultiProviderAIService().request_key("hello") != MultiProviderAIService().request_key("bye")
@@ -0,0 +1,113 @@
+import asyncio
+
+from services.provider_router import Backend, CircuitBreaker, ProviderRouter
+
+
+class HangingService:
+    """Never answers, like an upstream that stalls until the client gives up"""
+
+    async def complete(self, message, system_prompt=None, history=None):
+        await asyncio.Event().wait()
+
+    async def stream(self, message, system_prompt=None, history=None):
+        await asyncio.Event().wait()
+        yield ""
+
+
+def half_open_backend() -> Backend:
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    return Backend("hanging", HangingService(), breaker=breaker)
+
+
+async def cancel_soon(coro):
+    task = asyncio.ensure_future(coro)
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def test_cancelled_complete_releases_half_open_trial():
+    backend = half_open_backend()
+    router = ProviderRouter([backend])
+
+    async def run():
+        task = asyncio.ensure_future(router.complete("hi"))
+        await asyncio.sleep(0.01)
+        assert not backend.breaker.allow()  # The trial is in flight
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert backend.breaker.allow()
+    assert backend.breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_cancelled_stream_releases_half_open_trial():
+    backend = half_open_backend()
+    router = ProviderRouter([backend])
+
+    async def consume():
+        async for _ in router.stream("hi"):
+            pass
+
+    asyncio.run(cancel_soon(consume()))
+    assert backend.breaker.allow()
+
+
+def test_hedge_loser_releases_half_open_trial():
+    class FastService:
+        async def stream(self, message, system_prompt=None, history=None):
+            yield "answer"
+
+    loser = half_open_backend()
+    winner = Backend("fast", FastService())
+    winner.ewma_latency = 1.0  # Ranked after the half-open backend, so it only runs as the hedge
+    router = ProviderRouter([loser, winner], hedge_enabled=True, hedge_max_delay=0.01)
+
+    async def consume():
+        return [chunk async for chunk in router.stream("hi")]
+
+    assert asyncio.run(consume()) == ["answer"]
+    assert loser.breaker.allow()
+
+
+class BrokenMidStreamService:
+    """Sends one token, then the upstream drops the connection"""
+
+    async def stream(self, message, system_prompt=None, history=None):
+        yield "partial"
+        raise ConnectionError("upstream went away")
+
+
+def test_stream_failing_after_first_token_counts_once_as_a_failure():
+    backend = Backend("broken", BrokenMidStreamService())
+    router = ProviderRouter([backend])
+
+    async def consume():
+        async for _ in router.stream("hi"):
+            pass
+
+    try:
+        asyncio.run(consume())
+    except ConnectionError:
+        pass
+    assert (backend.requests, backend.errors) == (1, 1)
+    assert backend.ewma_error_rate == backend.alpha
+    assert backend.ewma_latency is not None  # Time to first token is still measured
+
+
+def test_finished_stream_counts_once_as_a_success():
+    class TwoTokens:
+        async def stream(self, message, system_prompt=None, history=None):
+            yield "a"
+            yield "b"
+
+    backend = Backend("ok", TwoTokens())
+
+    async def consume():
+        return [chunk async for chunk in ProviderRouter([backend]).stream("hi")]
+
+    assert asyncio.run(consume()) == ["a", "b"]
+    assert (backend.requests, backend.errors) == (1, 0)
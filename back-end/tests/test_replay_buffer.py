@@ -0,0 +1,34 @@
+import asyncio
+
+from services.replay_buffer import ReplayStore
+
+
+def test_eviction_prefers_finished_buffers_over_live_ones():
+    async def run():
+        store = ReplayStore(max_streams=2)
+        live = store.create()
+        live.task = asyncio.create_task(asyncio.Event().wait())
+        finished = store.create()
+        finished.finish()
+        newest = store.create()
+        await asyncio.sleep(0)
+        assert store.get(finished.request_id) is None
+        assert store.get(live.request_id) is live
+        assert not live.task.done()
+        live.task.cancel()
+        assert store.get(newest.request_id) is newest
+
+    asyncio.run(run())
+
+
+def test_evicting_a_live_buffer_cancels_its_generation():
+    async def run():
+        store = ReplayStore(max_streams=1)
+        live = store.create()
+        live.task = asyncio.create_task(asyncio.Event().wait())
+        store.create()
+        await asyncio.wait([live.task], timeout=1)
+        assert store.get(live.request_id) is None
+        assert live.task.cancelled()
+
+    asyncio.run(run())
@@ -0,0 +1,23 @@
+import asyncio
+
+from services.response_cache import ResponseCache
+
+
+def test_async_api_reads_and_writes_the_disk_tier(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResponseCache(disk_path=path)
+
+    async def run():
+        assert await cache.aget("k") is None
+        cache.set_nowait("k", "answer")
+        assert await cache.aget("k") == "answer"  # Served from memory while the write is queued
+
+    asyncio.run(run())
+    cache._disk_writer.shutdown(wait=True)
+
+    # A fresh cache (as after a restart) finds the answer on disk and promotes it
+    restarted = ResponseCache(disk_path=path)
+    assert asyncio.run(restarted.aget("k")) == "answer"
+    assert restarted.stats()["disk_hits"] == 1
+    assert restarted.get("k") == "answer"
+    assert restarted.stats()["hits"] == 2
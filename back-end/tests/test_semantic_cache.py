@@ -0,0 +1,36 @@
+import random
+
+import numpy as np
+
+from services.semantic_cache import SemanticCache
+
+
+def test_paraphrase_hits():
+    cache = SemanticCache(max_entries=100)
+    cache.add("what is zbot?", "ZBot is an AI assistant.")
+    assert cache.lookup("what's ZBot") == "ZBot is an AI assistant."
+    assert cache.lookup("how do I bake bread") is None
+
+
+def test_int8_scan_matches_exact_cosine():
+    """The quantized scan must never drop an entry the exact vectors put above the threshold"""
+    rng = random.Random(7)
+    vocab = [f"word{i}" for i in range(60)]
+    cache = SemanticCache(max_entries=3000, threshold=0.6)
+    prompts = [" ".join(rng.choices(vocab, k=rng.randint(2, 8))) for _ in range(3000)]
+    for i, prompt in enumerate(prompts):
+        cache.add(prompt, f"answer {i}", dedupe=False)
+
+    stored = np.zeros((len(prompts), cache.vectorizer.dim), dtype=np.float32)
+    for slot, prompt in enumerate(prompts):
+        indices, values = cache.vectorizer.sparse(prompt)
+        stored[slot, indices] = values
+
+    for _ in range(200):
+        indices, values = cache.vectorizer.sparse(" ".join(rng.choices(vocab, k=rng.randint(2, 8))))
+        exact = stored[:, indices] @ values
+        best = cache._top_k(indices, values, 1, None, 0.0, cache.threshold)
+        if exact.max() >= cache.threshold:
+            assert best and abs(best[0][0] - exact.max()) < 1e-5
+        else:
+            assert best == []
@@ -0,0 +1,49 @@
+import asyncio
+
+from services.stream_coalescer import StreamCoalescer
+
+
+def test_last_subscriber_leaving_cancels_and_closes_the_upstream_stream():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        closed = asyncio.Event()
+
+        async def upstream():
+            try:
+                yield "first"
+                await asyncio.sleep(60)
+                yield "never"
+            finally:
+                closed.set()
+
+        subscriber = coalescer.stream("key", upstream)
+        assert await subscriber.__anext__() == "first"
+        task = coalescer._flights["key"].task
+        await subscriber.aclose()
+
+        await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), 1)
+        assert task.cancelled()
+        assert closed.is_set()
+        assert coalescer.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_subscribers_share_one_upstream_stream():
+    async def scenario():
+        coalescer = StreamCoalescer()
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            for chunk in ["a", "b", "c"]:
+                await asyncio.sleep(0)
+                yield chunk
+
+        async def read():
+            return [chunk async for chunk in coalescer.stream("key", upstream)]
+
+        assert await asyncio.gather(read(), read()) == [["a", "b", "c"]] * 2
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,25 @@
+import asyncio
+
+from app.telemetry import TimingMiddleware
+from services.metrics import http_request_duration, set_provider
+
+
+def observed(provider: str) -> int:
+    return sum(series[-1] for key, series in http_request_duration._series.items() if key[-1] == provider)
+
+
+async def streaming_app(scope, receive, send):
+    """Sends its headers before the router has picked a backend, like an SSE response"""
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    set_provider("ollama@test")
+    await send({"type": "http.response.body", "body": b"data", "more_body": False})
+
+
+def test_http_latency_is_labelled_with_the_backend_that_served_it():
+    async def noop(message):
+        pass
+
+    before = observed("ollama@test")
+    scope = {"type": "http", "path": "/api/chat/stream", "method": "POST", "route": object()}
+    asyncio.run(TimingMiddleware(streaming_app)(scope, None, noop))
+    assert observed("ollama@test") == before + 1
@@ -0,0 +1,86 @@
+import asyncio
+
+from app import ws_handler
+from services import openai_services
+from services.replay_buffer import ReplayBuffer
+from services.session_memory import new_session
+
+
+class FailingCompletions:
+    async def create(self, **kwargs):
+        raise Exception("Error code: 503 - upstream unavailable")
+
+
+class FailingClient:
+    class chat:
+        completions = FailingCompletions()
+
+
+def run_generation(monkeypatch, session=None) -> list:
+    """Frames a client would receive for one generation whose upstream fails"""
+    monkeypatch.setattr(openai_services, "get_async_client", lambda: FailingClient())
+    monkeypatch.setattr(ws_handler, "reply_stream",
+                        lambda message, history=None: openai_services.stream_chat_completion(message, use_cache=False))
+
+    async def run():
+        buffer = ReplayBuffer("r1")
+        await ws_handler.produce(buffer, "hello", session)
+        return [frame async for frame in ws_handler.buffer_frames(buffer)]
+
+    return asyncio.run(run())
+
+
+def test_upstream_failure_is_sent_as_an_error_frame(monkeypatch):
+    frames = run_generation(monkeypatch)
+    assert [f["type"] for f in frames] == ["start", "error"]
+    assert frames[-1]["error"] == "OpenAI is down"
+
+
+def test_upstream_failure_is_not_saved_to_session_memory(monkeypatch):
+    session = new_session()
+    run_generation(monkeypatch, session)
+    assert session.token_count() == 0
+
+
+class RecordingSocket:
+    headers: dict = {}
+    client = None
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+
+def test_connection_drops_buffers_once_they_are_sent():
+    async def run():
+        connection = ws_handler.Connection(RecordingSocket())
+        buffer = ReplayBuffer("r1")
+        buffer.append("hi")
+        buffer.finish()
+        connection.follow(buffer)
+        await asyncio.gather(*connection.senders)
+        return connection
+
+    connection = asyncio.run(run())
+    assert connection.buffers == {}
+    assert len(connection.websocket.sent) == 3  # start, chunk, done
+
+
+def test_closing_a_connection_releases_live_generations(monkeypatch):
+    monkeypatch.setattr(ws_handler, "RESUME_GRACE_SECONDS", 0)
+
+    async def run():
+        connection = ws_handler.Connection(RecordingSocket())
+        buffer = ReplayBuffer("r1")
+        buffer.task = asyncio.create_task(asyncio.Event().wait())
+        connection.follow(buffer)
+        await asyncio.sleep(0)
+        await connection.close()
+        await asyncio.gather(buffer.task, return_exceptions=True)
+        return connection, buffer
+
+    connection, buffer = asyncio.run(run())
+    assert connection.buffers == {}
+    assert buffer.task.cancelled()
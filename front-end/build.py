@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Production build for the ZBot frontend
+Minifies the assets, names script.js and style.css after a hash of their content
+(so they can be cached forever and a new build is picked up through index.html),
+and writes gzip and, when the brotli package is installed, brotli variants next
+to every file. The result goes to dist/, which nginx and serve.py serve as is.
+
+    python build.py [output dir]
+"""
+
+import gzip
+import hashlib
+import json
+import re
+import shutil
+import sys
+from pathlib import Path
+
+try:
+    import brotli  # Optional: pip install brotli
+except ImportError:
+    brotli = None
+
+SOURCE_DIR = Path(__file__).parent
+# Assets referenced from the pages; they get content-hashed names
+HASHED_ASSETS = ["style.css", "script.js"]
+PAGES = ["index.html", "server.html"]
+COMPRESSIBLE = (".html", ".css", ".js", ".json", ".svg")
+
+
+def minify_css(text: str) -> str:
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    # Spaces around ':' are left alone: in selectors they separate a descendant from a pseudo-class
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    # Inside declaration blocks they only separate a property from its value
+    text = re.sub(r"\{([^{}]*)\}", lambda m: "{" + re.sub(r":\s+", ":", m.group(1)) + "}", text)
+    return text.replace(";}", "}").strip()
+
+
+def minify_js(text: str) -> str:
+    """Drop comments and indentation; strings, template literals and regexes pass through untouched
+
+    Line breaks are kept so automatic semicolon insertion still sees the same code.
+    """
+    out = []
+    i, n = 0, len(text)
+    last = ""  # Last significant character written, to tell a regex from a division
+    while i < n:
+        c = text[i]
+        if c in "'\"`":
+            end = i + 1
+            while end < n and text[end] != c:
+                end += 2 if text[end] == "\\" else 1
+            out.append(text[i:end + 1])
+            last = c
+            i = end + 1
+        elif text.startswith("//", i):
+            i = text.find("\n", i)
+            i = n if i < 0 else i
+        elif text.startswith("/*", i):
+            i = text.find("*/", i + 2) + 2
+        elif c == "/" and last in "(,=:[!&|?{};+-*%<>~^" or c == "/" and not last:
+            end = i + 1
+            in_class = False
+            while end < n and (text[end] != "/" or in_class):
+                if text[end] == "\\":
+                    end += 1
+                elif text[end] == "[":
+                    in_class = True
+                elif text[end] == "]":
+                    in_class = False
+                end += 1
+            out.append(text[i:end + 1])
+            last = "/"
+            i = end + 1
+        elif c == "\n":
+            if out and out[-1] == " ":
+                out.pop()  # Trailing space left by a dropped comment
+            if out and out[-1][-1:] != "\n":
+                out.append(c)
+            i += 1
+        elif c in " \t\r":
+            i += 1
+            # One space is kept between words; none at the start or end of a line
+            if out and out[-1][-1:] not in " \n" and i < n and text[i] not in " \t\r\n":
+                out.append(" ")
+        else:
+            out.append(c)
+            last = c
+            i += 1
+    return "".join(out).strip() + "\n"
+
+
+def minify_html(text: str) -> str:
+    """Drop comments and indentation (the pages have no <pre> blocks or whitespace-sensitive text)"""
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.S)
+    lines = (line.strip() for line in text.split("\n"))
+    return "\n".join(line for line in lines if line) + "\n"
+
+
+MINIFIERS = {".css": minify_css, ".js": minify_js, ".html": minify_html}
+
+
+def hashed_name(name: str, content: bytes) -> str:
+    stem, suffix = name.rsplit(".", 1)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:10]}.{suffix}"
+
+
+def compress(path: Path) -> dict:
+    """Write .gz (and .br) variants of a file, skipping any that would not be smaller"""
+    data = path.read_bytes()
+    sizes = {"raw": len(data)}
+    # mtime=0 keeps the output identical between builds of the same source
+    variants = [("gz", gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(("br", brotli.compress(data, quality=11)))
+    for suffix, packed in variants:
+        if len(packed) < len(data):
+            path.with_name(f"{path.name}.{suffix}").write_bytes(packed)
+            sizes[suffix] = len(packed)
+    return sizes
+
+
+def build(out_dir: Path) -> dict:
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+
+    manifest = {}
+    for name in HASHED_ASSETS:
+        content = MINIFIERS[Path(name).suffix]((SOURCE_DIR / name).read_text(encoding="utf-8")).encode("utf-8")
+        manifest[name] = hashed_name(name, content)
+        (out_dir / manifest[name]).write_bytes(content)
+
+    for name in PAGES:
+        page = minify_html((SOURCE_DIR / name).read_text(encoding="utf-8"))
+        for asset, hashed in manifest.items():
+            page = re.sub(rf'(src|href)="{re.escape(asset)}"', rf'\1="{hashed}"', page)
+        (out_dir / name).write_text(page, encoding="utf-8")
+
+    (out_dir / "manifest.json").write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    sizes = {}
+    for path in sorted(out_dir.iterdir()):
+        if path.suffix in COMPRESSIBLE:
+            sizes[path.name] = compress(path)
+    return sizes
+
+
+def main():
+    out_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else SOURCE_DIR / "dist"
+    sizes = build(out_dir)
+    for name, size in sizes.items():
+        print(f"{name:32} " + "  ".join(f"{kind} {value:>6}" for kind, value in size.items()))
+    if brotli is None:
+        print("brotli not installed: only gzip variants were written (pip install brotli)")
+    print(f"Built into {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
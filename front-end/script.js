@@ -3,6 +3,11 @@ class ZBotChat {
         this.ws = null;
         this.isConnected = false;
         this.messageHistory = [];
+        // Answers in progress by generation id: { id, seq (chunks received), element, text }
+        this.answers = new Map();
+        // Answers whose start frame has not arrived yet, by the ref sent with the message
+        this.pendingRefs = new Map();
+        this.nextRef = 1;
         
         // DOM elements
         this.messagesContainer = document.getElementById('messages');
@@ -32,6 +37,13 @@ class ZBotChat {
             }
         });
         
+        // Escape stops the answers still being generated
+        document.addEventListener('keydown', (e) => {
+            if (e.key === 'Escape') {
+                this.cancelAnswers();
+            }
+        });
+        
         // Auto-resize textarea
         this.promptInput.addEventListener('input', () => {
             this.updateCharCount();
@@ -104,16 +116,15 @@ class ZBotChat {
                 this.isConnected = true;
                 this.updateStatus('Connected', 'connected');
                 console.log('Connected to ZBot server');
+                
+                // Pick up answers that were cut off where we left them
+                for (const answer of this.answers.values()) {
+                    this.ws.send(JSON.stringify({ resume: { id: answer.id, offset: answer.seq } }));
+                }
             };
             
             this.ws.onmessage = (event) => {
-                try {
-                    const data = JSON.parse(event.data);
-                    this.handleResponse(data);
-                } catch (error) {
-                    console.error('Error parsing message:', error);
-                    this.addMessage('Error parsing server response', 'bot');
-                }
+                this.handleFrame(event.data);
             };
             
             this.ws.onclose = () => {
@@ -121,6 +132,13 @@ class ZBotChat {
                 this.updateStatus('Disconnected', 'error');
                 console.log('Disconnected from ZBot server');
                 
+                // Messages the server never acknowledged cannot be resumed
+                for (const loading of this.pendingRefs.values()) {
+                    if (loading) loading.remove();
+                    this.addMessage('The connection dropped before your message was received. Please send it again.', 'bot');
+                }
+                this.pendingRefs.clear();
+                
                 // Attempt to reconnect after 3 seconds
                 setTimeout(() => {
                     if (!this.isConnected) {
@@ -157,13 +175,15 @@ class ZBotChat {
         // Send to server if connected
         if (this.isConnected && this.ws && this.ws.readyState === WebSocket.OPEN) {
             try {
+                const ref = String(this.nextRef++);
                 this.ws.send(JSON.stringify({
                     message: message,
+                    ref: ref,
                     timestamp: new Date().toISOString()
                 }));
                 
-                // Show loading indicator
-                this.showLoadingMessage();
+                // Show loading indicator; the answer takes its place when it starts
+                this.pendingRefs.set(ref, this.showLoadingMessage());
                 
             } catch (error) {
                 console.error('Error sending message:', error);
@@ -175,16 +195,92 @@ class ZBotChat {
         }
     }
     
-    handleResponse(data) {
-        // Remove loading message if present
-        this.removeLoadingMessage();
+    handleFrame(raw) {
+        let frame;
+        try {
+            frame = JSON.parse(raw);
+        } catch (error) {
+            console.error('Error parsing message:', error);
+            return;
+        }
         
-        if (data.response) {
-            this.addMessage(data.response, 'bot');
-        } else if (data.error) {
-            this.addMessage(`Error: ${data.error}`, 'bot');
+        switch (frame.type) {
+            case 'start':
+                this.startAnswer(frame);
+                break;
+            case 'chunk':
+                this.appendToAnswer(frame);
+                break;
+            case 'done':
+                this.finishAnswer(frame.id);
+                break;
+            case 'error':
+                this.failAnswer(frame);
+                break;
+            case 'timing':
+                console.debug('Answer timing:', frame.timing);
+                break;
+            default:
+                console.warn('Unknown frame:', frame);
+        }
+    }
+    
+    startAnswer(frame) {
+        const existing = this.answers.get(frame.id);
+        if (existing) {
+            // Resumed: the server continues from the chunk we asked for
+            existing.seq = frame.seq;
+            return;
+        }
+        const loading = this.pendingRefs.get(frame.ref);
+        this.pendingRefs.delete(frame.ref);
+        this.answers.set(frame.id, { id: frame.id, seq: 0, element: null, loading: loading, text: '' });
+    }
+    
+    appendToAnswer(frame) {
+        const answer = this.answers.get(frame.id);
+        if (!answer || frame.seq !== answer.seq) return;  // Unknown answer or a chunk we already have
+        if (!answer.element) {
+            answer.element = this.createMessageElement('', 'bot', answer.loading);
+            answer.loading = null;
+        }
+        answer.text += frame.text;
+        answer.seq += 1;
+        answer.element.textContent = answer.text;
+        this.scrollToBottom();
+    }
+    
+    finishAnswer(id) {
+        const answer = this.answers.get(id);
+        if (!answer) return;
+        this.answers.delete(id);
+        if (answer.loading) answer.loading.remove();
+        if (answer.text) {
+            this.messageHistory.push({ content: answer.text, sender: 'bot', timestamp: new Date() });
+        }
+    }
+    
+    failAnswer(frame) {
+        let loading = null;
+        if (frame.id && this.answers.has(frame.id)) {
+            loading = this.answers.get(frame.id).loading;
+            this.finishAnswer(frame.id);
+        } else if (frame.ref !== undefined && this.pendingRefs.has(frame.ref)) {
+            loading = this.pendingRefs.get(frame.ref);
+            this.pendingRefs.delete(frame.ref);
+            loading.remove();
+        }
+        if (frame.expired) {
+            this.addMessage('The connection dropped and the answer could not be recovered. Please ask again.', 'bot');
         } else {
-            this.addMessage('Received unknown response format', 'bot');
+            this.addMessage(`Error: ${frame.error}`, 'bot');
+        }
+    }
+    
+    cancelAnswers() {
+        if (!this.ws || this.ws.readyState !== WebSocket.OPEN) return;
+        for (const id of this.answers.keys()) {
+            this.ws.send(JSON.stringify({ cancel: { id: id } }));
         }
     }
     
@@ -213,6 +309,13 @@ class ZBotChat {
     }
     
     addMessage(content, sender) {
+        this.createMessageElement(content, sender);
+        
+        // Store in history
+        this.messageHistory.push({ content, sender, timestamp: new Date() });
+    }
+    
+    createMessageElement(content, sender, placeholder = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${sender}-message`;
         
@@ -225,11 +328,13 @@ class ZBotChat {
             </div>
         `;
         
-        this.messagesContainer.appendChild(messageDiv);
+        if (placeholder) {
+            placeholder.replaceWith(messageDiv);
+        } else {
+            this.messagesContainer.appendChild(messageDiv);
+        }
         this.scrollToBottom();
-        
-        // Store in history
-        this.messageHistory.push({ content, sender, timestamp: new Date() });
+        return messageDiv.querySelector('p');
     }
     
     showLoadingMessage() {
@@ -244,6 +349,7 @@ class ZBotChat {
         
         this.messagesContainer.appendChild(loadingDiv);
         this.scrollToBottom();
+        return loadingDiv;
     }
     
     removeLoadingMessage() {
@@ -2,51 +2,142 @@
 """
 Simple HTTP server for ZBot frontend development
 Serves the frontend and provides backend connection status
+
+Serves the production build in dist/ when there is one (run build.py first) and
+the source files otherwise, or with --source. Requests are handled on their own
+threads. Precompressed .br/.gz variants are sent to clients that accept them,
+hashed assets are cached as immutable and everything else revalidates by ETag.
 """
 
 import http.server
-import socketserver
 import os
+import re
 import sys
+from email.utils import formatdate
 from pathlib import Path
 
 # Configuration
 PORT = 3000
 BACKEND_URL = "http://localhost:8000"
 
+FRONTEND_DIR = Path(__file__).parent
+DIST_DIR = FRONTEND_DIR / "dist"
+# Names written by build.py, e.g. script.29056ddb4b.js
+HASHED_ASSET = re.compile(r"\.[0-9a-f]{10}\.(?:js|css)$")
+# Preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+
+def accepted_encodings(header: str) -> set:
+    """Codings from an Accept-Encoding header, leaving out any refused with q=0"""
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        if re.fullmatch(r"\s*q\s*=\s*0(\.0*)?\s*", params):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
 class ZBotHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    root = DIST_DIR if (DIST_DIR / "index.html").exists() else FRONTEND_DIR
+    # Keep-alive: a page and its assets come over one connection
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without TCP_NODELAY each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=str(Path(__file__).parent), **kwargs)
-    
+        super().__init__(*args, directory=str(self.root), **kwargs)
+
     def end_headers(self):
         # Add CORS headers for development
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
         super().end_headers()
-    
+
     def do_GET(self):
         # Serve index.html for root path
         if self.path == '/':
             self.path = '/index.html'
         elif self.path == '/status':
+            # Simple status check (you could enhance this)
+            body = b'{"status": "frontend_running", "backend": "check_docker"}'
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            # Simple status check (you could enhance this)
-            self.wfile.write(b'{"status": "frontend_running", "backend": "check_docker"}')
+            self.wfile.write(body)
             return
-        
+
         super().do_GET()
 
+    def do_HEAD(self):
+        if self.path == '/':
+            self.path = '/index.html'
+        super().do_HEAD()
+
+    def send_head(self):
+        """Like SimpleHTTPRequestHandler.send_head for files, with compressed variants, ETags and caching"""
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()  # Directories and 404s
+
+        encoding, variant = None, path
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding", ""))
+        for coding, suffix in ENCODINGS:
+            if coding in accepted and os.path.isfile(path + suffix):
+                encoding, variant = coding, path + suffix
+                break
+
+        try:
+            f = open(variant, "rb")
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        try:
+            stat = os.fstat(f.fileno())
+            # Per variant, so a cache never answers a gzip request with the brotli body
+            etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+            if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                f.close()
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_cache_headers(path)
+                self.end_headers()
+                return None
+
+            self.send_response(200)
+            self.send_header("Content-Type", self.guess_type(path))
+            self.send_header("Content-Length", str(stat.st_size))
+            self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+            self.send_header("ETag", etag)
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+            self.send_cache_headers(path)
+            self.end_headers()
+            return f
+        except Exception:
+            f.close()
+            raise
+
+    def send_cache_headers(self, path: str):
+        if HASHED_ASSET.search(path):
+            # The name changes whenever the content does
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+        else:
+            self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+
 def main():
-    # Change to frontend directory
-    frontend_dir = Path(__file__).parent
-    os.chdir(frontend_dir)
-    
+    if "--source" in sys.argv[1:]:
+        ZBotHTTPRequestHandler.root = FRONTEND_DIR
+
     print("🤖 Starting ZBot Frontend Development Server")
     print("=" * 50)
-    print(f"📁 Serving files from: {frontend_dir}")
+    print(f"📁 Serving files from: {ZBotHTTPRequestHandler.root}")
+    if ZBotHTTPRequestHandler.root == FRONTEND_DIR:
+        print("   (sources as they are; run build.py for the minified, precompressed build)")
     print(f"🌐 Frontend URL: http://localhost:{PORT}")
     print(f"🔌 Backend URL: {BACKEND_URL}")
     print("📡 WebSocket: ws://localhost:8000/ws")
@@ -55,15 +146,17 @@ def main():
     print("   docker-compose up -d backend")
     print("\n🚀 Access your ZBot at: http://localhost:3000")
     print("\n💡 Press Ctrl+C to stop the server\n")
-    
+
     try:
-        with socketserver.TCPServer(("", PORT), ZBotHTTPRequestHandler) as httpd:
+        # One thread per request, so a slow client does not hold up the others
+        with http.server.ThreadingHTTPServer(("", PORT), ZBotHTTPRequestHandler) as httpd:
+            httpd.daemon_threads = True
             httpd.serve_forever()
     except KeyboardInterrupt:
         print("\n👋 Shutting down ZBot frontend server...")
         sys.exit(0)
     except OSError as e:
-        if e.errno == 48:  # Address already in use
+        if e.errno in (48, 98):  # Address already in use (macOS, Linux)
             print(f"❌ Port {PORT} is already in use!")
             print("💡 Try closing other applications using this port or use a different port")
         else:
@@ -71,4 +164,4 @@ def main():
         sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()